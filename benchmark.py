@@ -0,0 +1,187 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import requests
+
+import gerry
+import mock_gerrit
+
+
+# Runs the crawlers against a local MockGerrit and reports changes/s,
+# requests/s, bytes/s, request latency percentiles and peak RSS. Every
+# scenario runs in a forked process so that peak RSS is its own.
+
+START_DATETIME = datetime.datetime(2018, 6, 1)
+SCENARIOS = ['sync', 'async', 'batch', 'raw', 'qt']
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def time_requests(latencies):
+    get = requests.get
+
+    def timed_get(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return get(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    requests.get = timed_get
+
+
+def run_gerry(scenario, url, args):
+    with tempfile.TemporaryDirectory() as directory:
+        instance = gerry.Gerry(
+            'mock', url, START_DATETIME, START_DATETIME + datetime.timedelta(days=args.days),
+            directory, concurrency=args.concurrency, rate=args.rate,
+            page_size=args.page_size, raw=scenario == 'raw', batch=scenario == 'batch')
+        instance.rate_controller.max_rate = args.rate
+        if scenario == 'async':
+            instance.run_async()
+        else:
+            instance.run()
+        return instance.manifest.summary()[1].get(gerry.Manifest.DONE, 0)
+
+
+def run_qt(url, args):
+    import pymongo
+    import qt_gerry_crawler
+    qt_gerry_crawler.base_url = url + '/'
+    qt_gerry_crawler.multiThread_cpu_num = args.concurrency
+    qt_gerry_crawler.client = pymongo.MongoClient(serverSelectionTimeoutMS=2000)
+    db = qt_gerry_crawler.client['gerry_benchmark']
+    qt_gerry_crawler.changes_collection = db['reviews']
+    qt_gerry_crawler.comments_collection = db['comments']
+    qt_gerry_crawler.inlines_collection = db['inlines']
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            # the crawler writes its dead letters to the working directory,
+            # the scenario runs in its own process
+            os.chdir(directory)
+            for status in ['merged', 'abandoned']:
+                qt_gerry_crawler.crawl_new_api(status, args.page_size)
+        return db['reviews'].count_documents({})
+    finally:
+        qt_gerry_crawler.client.drop_database('gerry_benchmark')
+
+
+def run_scenario(scenario, url, args, connection):
+    latencies = []
+    time_requests(latencies)
+    start = time.perf_counter()
+    try:
+        if scenario == 'qt':
+            changes = run_qt(url, args)
+        else:
+            changes = run_gerry(scenario, url, args)
+    except BaseException as exception:
+        # also report SystemExit and KeyboardInterrupt, the parent waits
+        # for a result
+        connection.send({'error': ('%s: %s' % (type(exception).__name__, exception))[:100]})
+        return
+    connection.send({'seconds': time.perf_counter() - start,
+                     'changes': changes,
+                     'latency_p50': percentile(latencies, 0.5),
+                     'latency_p90': percentile(latencies, 0.9),
+                     'latency_p99': percentile(latencies, 0.99),
+                     'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+
+
+def benchmark(scenario, args):
+    mock = mock_gerrit.MockGerrit(
+        mock_gerrit.synthetic_changes(args.changes, START_DATETIME, args.days, args.payload_size),
+        latency=args.latency,
+        error_rates={429: args.error_rate, 500: args.error_rate, 503: args.error_rate},
+        retry_after=0)
+    url = mock.start()
+    try:
+        context = multiprocessing.get_context('fork')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=run_scenario,
+                                  args=(scenario, url, args, sender))
+        process.start()
+        # only the child holds the sending end now, so that recv fails
+        # instead of blocking if the child dies without a result
+        sender.close()
+        try:
+            result = receiver.recv()
+        except EOFError:
+            result = None
+        process.join()
+        if result is None:
+            result = {'error': 'process exited with code %s' % process.exitcode}
+    finally:
+        mock.stop()
+    if 'error' not in result:
+        result['requests'] = mock.request_count
+        result['changes_per_second'] = result['changes'] / result['seconds']
+        result['requests_per_second'] = mock.request_count / result['seconds']
+        result['bytes_per_second'] = mock.bytes_sent / result['seconds']
+    return result
+
+
+def print_results(results, baseline=None):
+    columns = ['changes_per_second', 'requests_per_second', 'bytes_per_second',
+               'latency_p50', 'latency_p90', 'latency_p99', 'peak_rss_mb']
+    print('%-8s %s' % ('scenario', ' '.join('%20s' % column for column in columns)))
+    for scenario, result in results.items():
+        if 'error' in result:
+            print('%-8s skipped (%s)' % (scenario, result['error']))
+            continue
+        cells = []
+        for column in columns:
+            cell = '%.3f' % result[column] if column.startswith('latency') else '%.1f' % result[column]
+            if baseline and scenario in baseline and column in baseline[scenario] and baseline[scenario][column]:
+                cell += ' (%+.0f%%)' % (100.0 * (result[column] / baseline[scenario][column] - 1))
+            cells.append('%20s' % cell)
+        print('%-8s %s' % (scenario, ' '.join(cells)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('benchmark')
+    parser.add_argument('scenarios', nargs='*',
+                        help='any of %s, all by default' % ', '.join(SCENARIOS))
+    parser.add_argument('--changes', dest='changes', type=int, default=2000)
+    parser.add_argument('--days', dest='days', type=int, default=10)
+    parser.add_argument('--payload-size', dest='payload_size', type=int,
+                        default=2000)
+    parser.add_argument('--latency', dest='latency', type=float, default=0.01)
+    parser.add_argument('--error-rate', dest='error_rate', type=float,
+                        default=0.0)
+    parser.add_argument('--concurrency', dest='concurrency', type=int,
+                        default=8)
+    parser.add_argument('--rate', dest='rate', type=float, default=1000.0)
+    parser.add_argument('--page-size', dest='page_size', type=int,
+                        default=250)
+    parser.add_argument('--output', dest='output',
+                        help='write the results as JSON, e.g. to keep a baseline')
+    parser.add_argument('--baseline', dest='baseline',
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(unknown))
+
+    results = {}
+    for scenario in args.scenarios or SCENARIOS:
+        results[scenario] = benchmark(scenario, args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
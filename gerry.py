@@ -1,25 +1,39 @@
 import requests
+import asyncio
+import concurrent.futures
+import contextlib
 import datetime
+import email.utils
+import functools
 import json
 import os
 import argparse
 import glob
+import heapq
 import logging
+import multiprocessing
+import random
+import socket
+import sqlite3
 import tqdm
+import threading
 import time
 
+import gerry_storage
+
 log = logging.getLogger('gerry')
 
 
-def config_logging(data_dir):
+def config_logging(data_dir, logger=None):
     global log
+    logger = logger or log
     log.setLevel(logging.DEBUG)
     log_name = os.path.join(data_dir, 'gerry-crawl.log')
     formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
     file_handler = logging.FileHandler(log_name)
     file_handler.setFormatter(formatter)
-    log.addHandler(file_handler)
-    return log
+    logger.addHandler(file_handler)
+    return logger
 
 
 def create_time_frames(from_datetime, to_datetime, frame_size):
@@ -35,121 +49,1223 @@ def create_time_frames(from_datetime, to_datetime, frame_size):
     return result
 
 
+MIN_TIME_FRAME = datetime.timedelta(minutes=1)
+DETAIL_OPTIONS = ['DETAILED_LABELS', 'MESSAGES', 'DETAILED_ACCOUNTS', 'REVIEWED',
+                  'ALL_FILES', 'ALL_COMMITS', 'ALL_REVISIONS']
+# list queries accept the same options, but some servers leave out heavy
+# fields on them; changes missing one of these are fetched with /detail
+BATCH_REQUIRED_FIELDS = ['messages', 'revisions']
+
+
 def datetime_to_string(date):
     return date.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
 
 
+def parse_gerrit_timestamp(timestamp):
+    # Gerrit timestamps carry nanoseconds, e.g. 2018-06-01 12:00:00.000000000
+    return datetime.datetime.strptime(timestamp[:23], '%Y-%m-%d %H:%M:%S.%f')
+
+
+def strip_xssi(content):
+    # Gerrit prefixes JSON responses with )]}' against XSSI; only check that
+    # the rest looks like a complete JSON object instead of parsing it
+    if content.startswith(b")]}'"):
+        content = content[4:]
+    content = content.strip()
+    if not (content.startswith(b'{') and content.endswith(b'}')):
+        raise json.JSONDecodeError('Response is not a JSON object',
+                                   content[:100].decode('utf-8', 'replace'), 0)
+    return content
+
+
+def parse_retry_after(response):
+    # Retry-After is either delta-seconds or an HTTP-date
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+class RateController(object):
+    # Token bucket whose refill rate is adapted with AIMD: every successful
+    # request adds increase / rate to the rate (so roughly +increase per
+    # second), every throttled request multiplies it by decrease.
+    # https://cloud.google.com/service-control/troubleshooting#how_do_i_perform_a_retry_on_api_errors
+    GOOGLE_SERVER_WAITING_TIME = {429: 31, 500: 1, 503: 1}
+    THROTTLE_STATUS_CODES = (429, 503)
+
+    def __init__(self, name, rate=5.0, min_rate=0.2, max_rate=50.0,
+                 burst=5, increase=0.5, decrease=0.5, logger=None):
+        self.name = name
+        self.log = logger or log
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.peak_rate = 0.0
+        self.throttle_count = 0
+        self.next_slot = 0.0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            # a full bucket allows a burst of requests right away
+            self.next_slot = max(self.next_slot,
+                                 now - (self.burst - 1) / self.rate)
+            slot = max(self.next_slot, self.blocked_until)
+            self.next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate,
+                            self.rate + self.increase / self.rate)
+            self.peak_rate = max(self.peak_rate, self.rate)
+
+    def on_response(self, response):
+        if response.status_code not in self.GOOGLE_SERVER_WAITING_TIME:
+            self.on_success()
+            return
+        wait = parse_retry_after(response)
+        if wait is None:
+            wait = self.GOOGLE_SERVER_WAITING_TIME[response.status_code]
+        with self.lock:
+            self.blocked_until = max(self.blocked_until,
+                                     time.monotonic() + wait)
+            if response.status_code not in self.THROTTLE_STATUS_CODES:
+                return
+            self.throttle_count += 1
+            throttled_rate = self.rate
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.log.warning('%s throttled with http status %i at %.2f req/s, pausing %.1fs and continuing with %.2f req/s' % (
+            self.name, response.status_code, throttled_rate, wait, self.rate))
+
+    def report(self):
+        self.log.info('%s settled on %.2f req/s (peak %.2f req/s, throttled %i times)' % (
+            self.name, self.rate, self.peak_rate, self.throttle_count))
+
+
+class RetryScheduler(object):
+    # Failed units, like the listing of a window or a single change, wait on
+    # a priority queue ordered by the time of their next attempt. The delay
+    # doubles with every attempt up to cap, with full jitter so that units
+    # that failed together do not come back together. Every error class has
+    # its own budget of retries per unit, a unit that runs out of it becomes a
+    # dead letter.
+    BUDGETS = {'throttled': 8, 'server': 5, 'connection': 5, 'parse': 2,
+               'client': 0, 'other': 3}
+
+    def __init__(self, base=1.0, cap=300.0, budgets=None, seed=None):
+        self.base = base
+        self.cap = cap
+        self.budgets = dict(RetryScheduler.BUDGETS, **(budgets or {}))
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.queue = []
+        self.sequence = 0
+        self.attempts = {}
+        self.dead_letters = []
+
+    def error_class(exception):
+        response = getattr(exception, 'response', None)
+        if response is not None:
+            if response.status_code in RateController.THROTTLE_STATUS_CODES:
+                return 'throttled'
+            if response.status_code >= 500:
+                return 'server'
+            return 'client'
+        if isinstance(exception, requests.exceptions.RequestException):
+            return 'connection'
+        if isinstance(exception, ValueError):
+            return 'parse'
+        return 'other'
+
+    def schedule(self, unit, exception, description=None):
+        # False if the unit is dead
+        error_class = RetryScheduler.error_class(exception)
+        with self.lock:
+            attempts = self.attempts.setdefault(unit, {})
+            attempts[error_class] = attempts.get(error_class, 0) + 1
+            if attempts[error_class] > self.budgets[error_class]:
+                del self.attempts[unit]
+                self.dead_letters.append({
+                    'unit': description or str(unit),
+                    'error_class': error_class,
+                    'attempts': sum(attempts.values()),
+                    'error': str(exception)})
+                return False
+            delay = self.random.uniform(0, min(
+                self.cap, self.base * 2 ** (sum(attempts.values()) - 1)))
+            heapq.heappush(self.queue, (time.time() + delay, self.sequence, unit))
+            self.sequence += 1
+            return True
+
+    def pop_due(self):
+        now = time.time()
+        units = []
+        with self.lock:
+            while self.queue and self.queue[0][0] <= now:
+                units.append(heapq.heappop(self.queue)[2])
+        return units
+
+    def wait_time(self):
+        with self.lock:
+            if not self.queue:
+                return 0.0
+            return max(0.0, self.queue[0][0] - time.time())
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queue)
+
+    def write_report(self, file_name):
+        with self.lock:
+            dead_letters = list(self.dead_letters)
+        with open(file_name + '.tmp', 'w') as report_file:
+            json.dump(dead_letters, report_file, indent=2)
+        os.replace(file_name + '.tmp', file_name)
+
+
+class CrawlMetrics(object):
+    # Request latency, response bytes and status codes per endpoint, retries,
+    # time spent parsing and writing and crawled changes. Snapshots are
+    # written as metrics.json and as a Prometheus textfile metrics.prom.
+    LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+    def __init__(self, name, directory, interval=60):
+        self.name = name
+        self.directory = directory
+        self.file_name = 'metrics'
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.exported = time.time()
+        self.endpoints = {}
+        self.stages = {}
+        self.retries = 0
+        self.changes = 0
+
+    def observe_request(self, endpoint, seconds, size, status_code):
+        with self.lock:
+            metrics = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'seconds': 0.0, 'bytes': 0, 'status_codes': {},
+                'buckets': [0] * (len(CrawlMetrics.LATENCY_BUCKETS) + 1)})
+            metrics['requests'] += 1
+            metrics['seconds'] += seconds
+            metrics['bytes'] += size
+            status_code = str(status_code)
+            metrics['status_codes'][status_code] = metrics['status_codes'].get(status_code, 0) + 1
+            bucket = len([bound for bound in CrawlMetrics.LATENCY_BUCKETS if bound < seconds])
+            metrics['buckets'][bucket] += 1
+            # one thread claims each periodic export
+            export = time.time() - self.exported > self.interval
+            if export:
+                self.exported = time.time()
+        if export:
+            try:
+                self.export()
+            except OSError as error:
+                # a failed snapshot must not fail the request
+                log.warning('Exporting metrics of %s failed: %s' % (self.name, error))
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                metrics = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0})
+                metrics['count'] += 1
+                metrics['seconds'] += seconds
+
+    def count_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def count_changes(self, count=1):
+        with self.lock:
+            self.changes += count
+
+    def percentile(buckets, fraction):
+        # upper bound of the bucket the percentile falls into
+        total = sum(buckets)
+        seen = 0
+        for bound, count in zip(CrawlMetrics.LATENCY_BUCKETS + [float('inf')], buckets):
+            seen += count
+            if total and seen >= fraction * total:
+                return bound
+        return 0.0
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            endpoints = {}
+            for endpoint, metrics in self.endpoints.items():
+                endpoints[endpoint] = {
+                    'requests': metrics['requests'],
+                    'bytes': metrics['bytes'],
+                    'status_codes': dict(metrics['status_codes']),
+                    'mean_seconds': metrics['seconds'] / metrics['requests'],
+                    'p50_seconds': CrawlMetrics.percentile(metrics['buckets'], 0.5),
+                    'p90_seconds': CrawlMetrics.percentile(metrics['buckets'], 0.9),
+                    'p99_seconds': CrawlMetrics.percentile(metrics['buckets'], 0.99)}
+            return {'instance': self.name,
+                    'elapsed_seconds': elapsed,
+                    'endpoints': endpoints,
+                    'stages': {stage: dict(metrics) for stage, metrics in self.stages.items()},
+                    'retries': self.retries,
+                    'changes': self.changes,
+                    'changes_per_second': self.changes / elapsed}
+
+    def prometheus(self):
+        labels = 'instance="%s"' % self.name
+        lines = ['# TYPE gerry_requests_total counter']
+        with self.lock:
+            for endpoint, metrics in sorted(self.endpoints.items()):
+                for status_code, count in sorted(metrics['status_codes'].items()):
+                    lines.append('gerry_requests_total{%s,endpoint="%s",status="%s"} %i' % (
+                        labels, endpoint, status_code, count))
+            lines.append('# TYPE gerry_response_bytes_total counter')
+            for endpoint, metrics in sorted(self.endpoints.items()):
+                lines.append('gerry_response_bytes_total{%s,endpoint="%s"} %i' % (
+                    labels, endpoint, metrics['bytes']))
+            lines.append('# TYPE gerry_request_seconds histogram')
+            for endpoint, metrics in sorted(self.endpoints.items()):
+                cumulative = 0
+                for bound, count in zip(CrawlMetrics.LATENCY_BUCKETS + ['+Inf'], metrics['buckets']):
+                    cumulative += count
+                    lines.append('gerry_request_seconds_bucket{%s,endpoint="%s",le="%s"} %i' % (
+                        labels, endpoint, bound, cumulative))
+                lines.append('gerry_request_seconds_sum{%s,endpoint="%s"} %f' % (
+                    labels, endpoint, metrics['seconds']))
+                lines.append('gerry_request_seconds_count{%s,endpoint="%s"} %i' % (
+                    labels, endpoint, metrics['requests']))
+            lines.append('# TYPE gerry_stage_seconds_total counter')
+            for stage, metrics in sorted(self.stages.items()):
+                lines.append('gerry_stage_seconds_total{%s,stage="%s"} %f' % (
+                    labels, stage, metrics['seconds']))
+            lines.append('# TYPE gerry_retries_total counter')
+            lines.append('gerry_retries_total{%s} %i' % (labels, self.retries))
+            lines.append('# TYPE gerry_changes_total counter')
+            lines.append('gerry_changes_total{%s} %i' % (labels, self.changes))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        with self.lock:
+            self.exported = time.time()
+        for extension, content in [('.json', json.dumps(self.snapshot(), indent=2)),
+                                   ('.prom', self.prometheus())]:
+            # write and rename, so that readers never see a partial file; the
+            # temporary file is per thread in case an export overlaps the
+            # final one
+            file_name = os.path.join(self.directory, self.file_name + extension)
+            temp_file_name = '%s.%i-%i.tmp' % (file_name, os.getpid(), threading.get_ident())
+            with open(temp_file_name, 'w') as metrics_file:
+                metrics_file.write(content)
+            os.replace(temp_file_name, file_name)
+
+    def report(self, logger):
+        snapshot = self.snapshot()
+        logger.info('Crawled %i changes in %.0fs (%.2f changes/s), %i retries' % (
+            snapshot['changes'], snapshot['elapsed_seconds'],
+            snapshot['changes_per_second'], snapshot['retries']))
+        for endpoint, metrics in sorted(snapshot['endpoints'].items()):
+            logger.info('%s: %i requests, %i bytes, mean %.3fs, p90 <= %ss, status codes %s' % (
+                endpoint, metrics['requests'], metrics['bytes'], metrics['mean_seconds'],
+                metrics['p90_seconds'], metrics['status_codes']))
+        for stage, metrics in sorted(snapshot['stages'].items()):
+            logger.info('%s: %i times, %.2fs in total' % (
+                stage, metrics['count'], metrics['seconds']))
+
+
+class Manifest(object):
+    # Crawl state of every day and change, so that resuming only touches
+    # pending work. A day is pending until it is listed, listed until all of
+    # its changes are done, and failed if listing it failed.
+    PENDING = 'pending'
+    LISTED = 'listed'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path):
+        self.is_new = not os.path.exists(path)
+        self.connection = sqlite3.connect(path, timeout=60,
+                                          check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            # workers may open a new manifest at the same time, the
+            # immediate transaction lets one of them set up the schema
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS days (day TEXT PRIMARY KEY, status TEXT NOT NULL, updated_at TEXT NOT NULL, lease_owner TEXT, lease_expires REAL)')
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS changes (number INTEGER PRIMARY KEY, day TEXT NOT NULL, status TEXT NOT NULL, updated_at TEXT NOT NULL, error TEXT, etag TEXT)')
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS changes_day_status ON changes (day, status)')
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+                # manifests written before these columns existed
+                for table, column, column_type in [('changes', 'etag', 'TEXT'),
+                                                   ('days', 'lease_owner', 'TEXT'),
+                                                   ('days', 'lease_expires', 'REAL')]:
+                    columns = [row[1] for row in self.connection.execute(
+                        'PRAGMA table_info(%s)' % table)]
+                    if column not in columns:
+                        try:
+                            self.connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                                table, column, column_type))
+                        except sqlite3.OperationalError as error:
+                            if 'duplicate column' not in str(error):
+                                raise
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+
+    def now():
+        return datetime.datetime.utcnow().isoformat()
+
+    def add_days(self, days, status=PENDING):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO days (day, status, updated_at) VALUES (?, ?, ?)',
+                [(day, status, Manifest.now()) for day in days])
+
+    def pending_days(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT day, status FROM days WHERE status != ? ORDER BY day',
+                (Manifest.DONE,)).fetchall()
+
+    def set_day_status(self, day, status):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE days SET status = ?, updated_at = ? WHERE day = ?',
+                (status, Manifest.now(), day))
+
+    def add_changes(self, day, change_numbers, status=PENDING, listed=True):
+        # returns the change numbers that were not known yet
+        now = Manifest.now()
+        with self.lock, self.connection:
+            known = set()
+            for i in range(0, len(change_numbers), 500):
+                numbers = change_numbers[i:i + 500]
+                known.update(number for number, in self.connection.execute(
+                    'SELECT number FROM changes WHERE number IN (%s)' % ', '.join('?' * len(numbers)),
+                    numbers))
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO changes (number, day, status, updated_at) VALUES (?, ?, ?, ?)',
+                [(number, day, status, now) for number in change_numbers])
+            if listed:
+                self.connection.execute(
+                    'UPDATE days SET status = ?, updated_at = ? WHERE day = ? AND status != ?',
+                    (Manifest.LISTED, now, day, Manifest.DONE))
+        return [number for number in change_numbers if number not in known]
+
+    def set_listed(self, days):
+        now = Manifest.now()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE days SET status = ?, updated_at = ? WHERE day = ? AND status != ?',
+                [(Manifest.LISTED, now, day, Manifest.DONE) for day in days])
+
+    def refresh_changes(self, day, change_numbers):
+        # marks changes that were updated on the server as pending again;
+        # known changes keep their day so that their file is rewritten in place
+        now = Manifest.now()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO changes (number, day, status, updated_at) VALUES (?, ?, ?, ?)',
+                [(number, day, Manifest.PENDING, now) for number in change_numbers])
+            self.connection.executemany(
+                'UPDATE changes SET status = ?, updated_at = ? WHERE number = ?',
+                [(Manifest.PENDING, now, number) for number in change_numbers])
+            # only done days of the refreshed changes go back to listed, the
+            # others are still listed themselves with their pending changes
+            self.connection.executemany(
+                'UPDATE days SET status = ?, updated_at = ? WHERE status = ? AND day = '
+                '(SELECT day FROM changes WHERE number = ?)',
+                [(Manifest.LISTED, now, Manifest.DONE, number) for number in change_numbers])
+
+    def change_day(self, change_number):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT day FROM changes WHERE number = ?', (change_number,)).fetchone()
+        return row[0] if row else None
+
+    def etags(self, day):
+        with self.lock:
+            return dict(self.connection.execute(
+                'SELECT number, etag FROM changes WHERE day = ? AND etag IS NOT NULL', (day,)))
+
+    def get_state(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+    def pending_changes(self, day):
+        with self.lock:
+            return [number for number, in self.connection.execute(
+                'SELECT number FROM changes WHERE day = ? AND status != ? ORDER BY number',
+                (day, Manifest.DONE))]
+
+    def set_change_status(self, change_number, status, error=None, etag=None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE changes SET status = ?, updated_at = ?, error = ?, etag = COALESCE(?, etag) WHERE number = ?',
+                (status, Manifest.now(), error, etag, change_number))
+
+    def set_changes_status(self, change_numbers, status):
+        now = Manifest.now()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE changes SET status = ?, updated_at = ?, error = NULL WHERE number = ?',
+                [(status, now, number) for number in change_numbers])
+
+    def finish_day(self, day):
+        with self.lock, self.connection:
+            return self.connection.execute(
+                'UPDATE days SET status = ?, updated_at = ? WHERE day = ? AND status = ? AND NOT EXISTS '
+                '(SELECT 1 FROM changes WHERE day = ? AND status != ?)',
+                (Manifest.DONE, Manifest.now(), day, Manifest.LISTED, day, Manifest.DONE)).rowcount == 1
+
+    def claim_days(self, owner, count, lease_seconds, exclude=()):
+        # leases let several processes, also on other hosts sharing the
+        # directory, split the pending days; a lease that expires because its
+        # worker died is claimed again by the next worker
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                days = self.connection.execute(
+                    'SELECT day, status FROM days WHERE status != ? AND '
+                    '(lease_expires IS NULL OR lease_expires < ? OR lease_owner = ?) AND day NOT IN (%s) ORDER BY day LIMIT ?'
+                    % ', '.join('?' * len(exclude)),
+                    (Manifest.DONE, now, owner) + tuple(exclude) + (count,)).fetchall()
+                self.connection.executemany(
+                    'UPDATE days SET lease_owner = ?, lease_expires = ? WHERE day = ?',
+                    [(owner, now + lease_seconds, day) for day, _ in days])
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        return days
+
+    def renew_days(self, owner, lease_seconds):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE days SET lease_expires = ? WHERE lease_owner = ?',
+                (time.time() + lease_seconds, owner))
+
+    def release_days(self, owner):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE days SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ?',
+                (owner,))
+
+    def close(self):
+        self.connection.close()
+
+    def summary(self):
+        with self.lock:
+            days = dict(self.connection.execute(
+                'SELECT status, COUNT(*) FROM days GROUP BY status'))
+            changes = dict(self.connection.execute(
+                'SELECT status, COUNT(*) FROM changes GROUP BY status'))
+        return days, changes
+
+
 class Gerry(object):
     def __init__(self, name, url, start_date, end_date,
-                 directory='./gerry_data/'):
+                 directory='./gerry_data/', concurrency=8, rate=5.0,
+                 page_size=250, max_window_days=32, storage='files', raw=False,
+                 batch=False, budget=None, cache_size=None,
+                 intern_accounts=False):
         self.name = name
         self.url = url
         self.directory = os.path.join(directory, name)
         self.start_date = start_date
         self.end_date = end_date
+        self.concurrency = concurrency
+        self.log = log.getChild(name)
+        self.budget = budget
+        self.rate_controller = RateController(name, rate=rate, logger=self.log)
+        self.metrics = CrawlMetrics(name, self.directory)
+        self.retries = RetryScheduler()
+        self.dead_letters_file_name = 'dead_letters.json'
+        self.page_size = page_size
+        self.max_window_days = max_window_days
+        self.window_days = 1
+        self.manifest = None
+        self.raw = raw
+        self.batch = batch
         os.makedirs(self.directory, exist_ok=True)
+        self.storage = gerry_storage.create_storage(
+            storage, self.directory, intern_accounts)
+        self.cache = None
+        if cache_size is not None:
+            self.cache = gerry_storage.ResponseCache(
+                os.path.join(self.directory, 'cache.sqlite'), cache_size * 1024 ** 2)
 
-    def wait_for_server(status_code):
-        # https://cloud.google.com/service-control/troubleshooting#how_do_i_perform_a_retry_on_api_errors
-        GOOGLE_SERVER_WAITING_TIME = {429: 31, 500: 1, 503: 1}
-        if status_code in GOOGLE_SERVER_WAITING_TIME:
-            time.sleep(GOOGLE_SERVER_WAITING_TIME[status_code])
+    def get(self, url, headers=None, endpoint='detail'):
+        self.rate_controller.acquire()
+        if self.budget is not None:
+            self.budget.acquire()
+        start = time.perf_counter()
+        try:
+            response = requests.get(url, headers=headers)
+        except requests.exceptions.RequestException:
+            self.metrics.observe_request(
+                endpoint, time.perf_counter() - start, 0, 'error')
+            raise
+        self.metrics.observe_request(endpoint, time.perf_counter() - start,
+                                     len(response.content), response.status_code)
+        self.rate_controller.on_response(response)
+        response.raise_for_status()
+        return response
 
-    def handle_exception(exception, change_type):
+    def handle_exception(self, exception, change_type):
         if isinstance(exception, requests.exceptions.RequestException):
             if exception.response is not None:
-                log.error('GET %s failed with http status %i' % (
+                self.log.error('GET %s failed with http status %i' % (
                     change_type, exception.response.status_code))
-                Gerry.wait_for_server(
-                    exception.response.status_code)
             else:
-                log.error('GET %s %s failed with error: %s' % (change_type,
-                                                               exception))
+                self.log.error('GET %s failed with error: %s' % (change_type,
+                                                            exception))
         elif isinstance(exception, json.JSONDecodeError):
-            log.error(
+            self.log.error(
                 'Reading JSON for %s failed' % (change_type))
         elif isinstance(exception, Exception):
-            log.error('Unknown error occurred for %s %s: %s' % (change_type,
-                                                                exception))
+            self.log.error('Unknown error occurred for %s: %s' % (change_type,
+                                                             exception))
+
+    def detail_options(self):
+        options = list(DETAIL_OPTIONS)
+        if self.name != 'libreoffice':
+            options.append('REVIEWER_UPDATES')
+        return options
+
+    def query_changes(self, from_datetime, to_datetime, offset=0, details=True):
+        url = '%s/changes/?q=after:{%s} AND before:{%s} AND is:closed&n=%i&S=%i' % (
+            self.url, datetime_to_string(from_datetime), datetime_to_string(to_datetime), self.page_size, offset)
+        if self.batch and details:
+            url += ''.join('&o=' + option for option in self.detail_options())
+        response = self.get(url, endpoint='changes')
+
+        with self.metrics.timer('parse'):
+            changes = json.loads(response.text[5:])
+        more_changes = bool(changes) and '_more_changes' in changes[-1]
+        return changes, more_changes
+
+    def list_pages(self, from_datetime, to_datetime):
+        # [from_datetime, to_datetime]; yields the changes page by page as they
+        # arrive. A window with more changes than fit on one page is split in
+        # halves instead of paging with deep offsets. In batch mode a window
+        # that can still be split is probed without the detail options first,
+        # so that the heavy pages are only requested for the final windows
+        time_frames = [(from_datetime, to_datetime)]
+
+        while time_frames:
+            time_frame_start, time_frame_end = time_frames.pop()
+            splittable = time_frame_end - time_frame_start > MIN_TIME_FRAME
+            changes_subset, more_changes = self.query_changes(
+                time_frame_start, time_frame_end, details=not splittable)
+
+            if more_changes and splittable:
+                time_frame_middle = time_frame_start + \
+                    (time_frame_end - time_frame_start) // 2
+                time_frame_middle -= datetime.timedelta(
+                    microseconds=time_frame_middle.microsecond % 1000)
+                time_frames += [(time_frame_middle + datetime.timedelta(milliseconds=1), time_frame_end),
+                                (time_frame_start, time_frame_middle)]
+                continue
+
+            if self.batch and splittable:
+                changes_subset, more_changes = self.query_changes(
+                    time_frame_start, time_frame_end)
+            yield changes_subset
+            offset = len(changes_subset)
+            while more_changes:
+                changes_subset, more_changes = self.query_changes(
+                    time_frame_start, time_frame_end, offset)
+                yield changes_subset
+                offset += len(changes_subset)
+
+    def list_changes(self, from_datetime, to_datetime):
+        return [change for changes in self.list_pages(from_datetime, to_datetime)
+                for change in changes]
 
     def get_changes(self, day):
         from_datetime = day
         to_datetime = from_datetime + \
             datetime.timedelta(hours=24) + datetime.timedelta(milliseconds=-1)
-        more_changes = True
-        changes = []
-        offset = 0
-
-        while more_changes:
-            changes_subset = []
-            url = '%s/changes/?q=after:{%s} AND before:{%s} AND is:closed&S=%i' % (
-                self.url, datetime_to_string(from_datetime), datetime_to_string(to_datetime), offset)
-            response = requests.get(url)
-            response.raise_for_status()
-
-            changes_subset = json.loads(response.text[5:])
-            if changes_subset:
-                more_changes = '_more_changes' in changes_subset[-1]
-                changes += changes_subset
-            else:
-                more_changes = False
-            offset += len(changes_subset)
-        return changes
+        return self.list_changes(from_datetime, to_datetime)
 
-    def get_change(self, change_number, folder):
-        url = '%s/changes/%s/detail/?o=DETAILED_LABELS&o=MESSAGES&o=DETAILED_ACCOUNTS&o=REVIEWED&o=ALL_FILES&o=ALL_COMMITS&o=ALL_REVISIONS' % (
-            self.url, change_number)
-        if self.name != 'libreoffice':
-            url += '&o=REVIEWER_UPDATES'
+    def change_url(self, change_number):
+        return '%s/changes/%s/detail/?o=%s' % (
+            self.url, change_number, '&o='.join(self.detail_options()))
 
-        response = requests.get(url)
-        response.raise_for_status()
+    def get_change(self, change_number, folder, etag=None):
+        url = self.change_url(change_number)
 
-        change = json.loads(response.text[5:])
-        file_name = str(change_number) + '.json'
-        with open(os.path.join(folder, file_name), 'w') as json_file:
-            json.dump(change, json_file)
+        # incremental refreshes pass the stored ETag and always go to the
+        # server, a closed change may have been restored in the meantime
+        cached = None
+        if self.cache is not None and etag is None:
+            cached = self.cache.get(url)
+        if cached is not None:
+            payload, etag = cached
+        else:
+            response = self.get(url, {'If-None-Match': etag} if etag else None)
+            if response.status_code == 304:
+                return etag
+            with self.metrics.timer('parse'):
+                payload = strip_xssi(response.content)
+            etag = response.headers.get('ETag')
 
-    def run(self):
+        if self.raw:
+            with self.metrics.timer('write'):
+                self.storage.write_raw(folder, change_number, payload)
+        else:
+            with self.metrics.timer('parse'):
+                change = json.loads(payload)
+            with self.metrics.timer('write'):
+                self.storage.write(folder, change_number, change)
+        if self.cache is not None and cached is None:
+            # only closed changes are listed, raw payloads are not parsed
+            closed = self.raw or change.get('status') in ('MERGED', 'ABANDONED')
+            self.cache.put(url, payload, etag, immutable=closed)
+        return etag
+
+    def open_manifest(self):
+        manifest = Manifest(os.path.join(self.directory, 'manifest.sqlite'))
+        if manifest.is_new:
+            # data directories crawled before the manifest existed may hold
+            # partial days: their changes count as done, but the days are
+            # listed again to find the changes that are missing
+            for day_path in glob.glob(os.path.join(self.directory, 'changes', '*')):
+                file_names = os.listdir(day_path)
+                if file_names:
+                    day_str = os.path.split(day_path)[1]
+                    manifest.add_days([day_str])
+                    manifest.add_changes(day_str, [
+                        int(file_name[:-5]) for file_name in file_names
+                        if file_name.endswith('.json')], Manifest.DONE, listed=False)
+        return manifest
+
+    def create_day_paths(self):
+        if self.manifest is None:
+            self.manifest = self.open_manifest()
+        days = []
         for time_frame in create_time_frames(
                 self.start_date, self.end_date, datetime.timedelta(hours=24)):
             day_str = time_frame[0].strftime('%Y-%m-%d')
-            os.makedirs(os.path.join(self.directory,
-                                     'changes', day_str), exist_ok=True)
+            self.storage.prepare_day(os.path.join(
+                self.directory, 'changes', day_str))
+            days.append(day_str)
+        self.manifest.add_days(days)
+
+    def list_window(self, day_strs):
+        # Lists the window page by page and yields the (day, change number)
+        # pairs of every page whose details are still missing. The days only
+        # count as listed once the last page is in, so that an interrupted
+        # listing is repeated.
+        from_datetime = datetime.datetime.strptime(day_strs[0], '%Y-%m-%d')
+        to_datetime = datetime.datetime.strptime(day_strs[-1], '%Y-%m-%d') + \
+            datetime.timedelta(hours=24) + datetime.timedelta(milliseconds=-1)
+        count = 0
+        for changes in self.list_pages(from_datetime, to_datetime):
+            count += len(changes)
+            changes_by_day = {}
+            for change in changes:
+                # the window is queried on the updated timestamp, so that
+                # decides the day folder; keep changes on the window's edges
+                # when the server does not run on UTC
+                day_str = min(max(change['updated'][:10], day_strs[0]), day_strs[-1])
+                changes_by_day.setdefault(day_str, []).append(change)
+            page = []
+            for day_str, day_changes in changes_by_day.items():
+                change_numbers = self.manifest.add_changes(
+                    day_str, [change['_number'] for change in day_changes],
+                    listed=False)
+                if self.batch:
+                    stored = set(self.store_batch(day_str, day_changes))
+                    change_numbers = [change_number for change_number in change_numbers
+                                      if change_number not in stored]
+                page += [(day_str, change_number) for change_number in change_numbers]
+            yield page
+        self.manifest.set_listed(day_strs)
 
-        all_day_paths = glob.glob(os.path.join(self.directory, 'changes', '*'))
+        # merge sparse days into one query, shrink the window again for busy
+        # ones
+        if count > self.page_size:
+            self.window_days = max(1, self.window_days // 2)
+        elif count < self.page_size // 4:
+            self.window_days = min(self.max_window_days, self.window_days * 2)
 
-        complete = False
+    def fail_window(self, day_strs):
+        for day_str in day_strs:
+            self.manifest.set_day_status(day_str, Manifest.FAILED)
 
-        while not complete:
-            complete = True
-            day_paths_pending = [
-                day_path for day_path in all_day_paths if not os.listdir(day_path)]
+    def store_batch(self, day_str, changes):
+        # changes listed with the detail options are stored as they are, the
+        # rest stays pending for get_change
+        day_path = os.path.join(self.directory, 'changes', day_str)
+        change_numbers = []
+        for change in changes:
+            change.pop('_more_changes', None)
+            if all(field in change for field in BATCH_REQUIRED_FIELDS):
+                with self.metrics.timer('write'):
+                    self.storage.write(day_path, change['_number'], change)
+                change_numbers.append(change['_number'])
+        self.manifest.set_changes_status(change_numbers, Manifest.DONE)
+        self.metrics.count_changes(len(change_numbers))
+        return change_numbers
+
+    def listing_windows(self, days):
+        # groups consecutive unlisted days into windows of self.window_days,
+        # which list_window adapts while the windows are consumed
+        i = 0
+        while i < len(days):
+            day_str, status = days[i]
+            window = [day_str]
+            if status != Manifest.LISTED:
+                next_day = datetime.datetime.strptime(day_str, '%Y-%m-%d')
+                while i + len(window) < len(days) and len(window) < self.window_days:
+                    next_day += datetime.timedelta(days=1)
+                    next_day_str, next_status = days[i + len(window)]
+                    if next_status == Manifest.LISTED or next_day_str != next_day.strftime('%Y-%m-%d'):
+                        break
+                    window.append(next_day_str)
+            yield window, status != Manifest.LISTED
+            i += len(window)
+
+    def finish_change(self, change_number, exception=None, etag=None):
+        if exception is None:
+            self.manifest.set_change_status(
+                change_number, Manifest.DONE, etag=etag)
+            self.metrics.count_changes()
+        else:
+            self.manifest.set_change_status(
+                change_number, Manifest.FAILED, str(exception))
+
+    def crawl_change(self, day_str, change_number, etag=None):
+        day_path = os.path.join(self.directory, 'changes', day_str)
+        try:
+            etag = self.get_change(change_number, day_path, etag)
+            self.finish_change(change_number, etag=etag)
+            return True
+        except Exception as exception:
+            self.handle_exception(exception, 'change ' + str(change_number))
+            self.finish_change(change_number, exception)
+            self.retry_later(('change', day_str, change_number, etag), exception)
+            return False
+
+    def crawl_day(self, day_str, fetched=()):
+        # changes that failed while their window was listed are already
+        # waiting for their retry
+        complete = True
+        etags = self.manifest.etags(day_str)
+        for change_number in self.manifest.pending_changes(day_str):
+            if change_number not in fetched:
+                complete = self.crawl_change(
+                    day_str, change_number, etags.get(change_number)) and complete
+
+        self.manifest.finish_day(day_str)
+        return complete
+
+    def crawl_window(self, day_strs, unlisted):
+        # details are fetched page by page while the window is listed
+        complete = True
+        fetched = set()
+        if unlisted:
+            try:
+                for page in self.list_window(day_strs):
+                    for day_str, change_number in page:
+                        complete = self.crawl_change(day_str, change_number) and complete
+                        fetched.add(change_number)
+            except Exception as exception:
+                self.handle_exception(exception, 'changes from %s to %s' % (
+                    day_strs[0], day_strs[-1]))
+                self.fail_window(day_strs)
+                self.retry_later(('window', tuple(day_strs)), exception)
+                return False
+        for day_str in day_strs:
+            complete = self.crawl_day(day_str, fetched) and complete
+        return complete
+
+    def describe(self, unit):
+        if unit[0] == 'window':
+            return 'changes from %s to %s' % (unit[1][0], unit[1][-1])
+        return 'change %i' % unit[2]
+
+    def retry_later(self, unit, exception):
+        # a unit that is out of retries stays failed in the manifest and is
+        # picked up again by the next run
+        if self.retries.schedule(unit, exception, self.describe(unit)):
+            self.metrics.count_retry()
+        else:
+            self.log.error('Giving up on %s' % self.describe(unit))
+
+    def retry(self, unit):
+        if unit[0] == 'window':
+            self.crawl_window(list(unit[1]), True)
+            return
+        _, day_str, change_number, etag = unit
+        if self.crawl_change(day_str, change_number, etag):
+            self.manifest.finish_day(day_str)
+
+    def retry_due(self, wait=False):
+        # with wait, until no unit is left to retry
+        while True:
+            units = self.retries.pop_due()
+            if not units:
+                if not wait or not self.retries:
+                    return
+                time.sleep(self.retries.wait_time())
+            for unit in units:
+                self.retry(unit)
+
+    def finish_run(self):
+        self.log_manifest_summary()
+        self.rate_controller.report()
+        self.metrics.export()
+        self.metrics.report(self.log)
+        if self.cache is not None:
+            self.cache.report(self.log)
+        if self.retries.dead_letters:
+            self.log.error('%i units ran out of retries, see %s' % (
+                len(self.retries.dead_letters), self.dead_letters_file_name))
+        self.retries.write_report(os.path.join(
+            self.directory, self.dead_letters_file_name))
+
+    def log_manifest_summary(self):
+        days, changes = self.manifest.summary()
+        self.log.info('Manifest: days %s, changes %s' % (days, changes))
+
+    def run(self):
+        self.create_day_paths()
+
+        days_pending = self.manifest.pending_days()
+        self.log.info('Started crawl of %i pending days' % (len(days_pending)))
+
+        # failed units are retried between windows once they are due, and
+        # at the end until they succeed or run out of retries
+        progress = tqdm.tqdm(total=len(days_pending))
+        for day_strs, unlisted in self.listing_windows(days_pending):
+            self.crawl_window(day_strs, unlisted)
+            self.retry_due()
+            progress.update(len(day_strs))
+        progress.close()
+        self.retry_due(wait=True)
+
+        self.finish_run()
+
+    def try_call(self, description, function, *args):
+        # runs inside a worker thread, so waiting for the server only blocks
+        # this request and not the event loop
+        try:
+            return function(*args)
+        except Exception as exception:
+            self.handle_exception(exception, description)
+            return exception
+
+    async def crawl_day_async(self, day_str, call, fetched=()):
+        etags = self.manifest.etags(day_str)
+        change_numbers = [change_number for change_number in self.manifest.pending_changes(day_str)
+                          if change_number not in fetched]
+        results = await asyncio.gather(*[
+            call('change ' + str(change_number),
+                 self.crawl_change, day_str, change_number, etags.get(change_number))
+            for change_number in change_numbers])
+        self.manifest.finish_day(day_str)
+        return all(results)
 
-            log.info(
-                'Started new crawl iteration to crawl %i pending days' % (len(day_paths_pending)))
+    async def crawl_async(self, days):
+        loop = asyncio.get_running_loop()
+        # one Gerry talks to one host, so these bound the parallelism per host
+        request_semaphore = asyncio.Semaphore(self.concurrency)
+        window_semaphore = asyncio.Semaphore(self.concurrency)
+        # listed changes that wait for their details; listing pauses when
+        # fetching falls more than a page behind
+        fetch_semaphore = asyncio.Semaphore(max(self.page_size, self.concurrency))
+        progress = tqdm.tqdm(total=len(days))
 
-            for day_path in tqdm.tqdm(day_paths_pending):
-                change_numbers = []
-                changes = []
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency) as executor:
 
-                day = datetime.datetime.strptime(
-                    os.path.split(day_path)[1], '%Y-%m-%d')
+            async def call(description, function, *args):
+                async with request_semaphore:
+                    return await loop.run_in_executor(
+                        executor, self.try_call, description, function, *args)
+
+            async def fetch(day_str, change_number):
+                try:
+                    return await call('change ' + str(change_number),
+                                      self.crawl_change, day_str, change_number)
+                finally:
+                    fetch_semaphore.release()
+
+            async def crawl_days(day_strs, listed, fetches, fetched):
                 try:
-                    changes = self.get_changes(day)
-                except Exception as exception:
-                    Gerry.handle_exception(exception, 'changes on ' + str(day))
-                    complete = False
+                    results = await asyncio.gather(*fetches)
+                    if not listed:
+                        return False
+                    results += await asyncio.gather(*[
+                        self.crawl_day_async(day_str, call, fetched) for day_str in day_strs])
+                    return all(results)
+                finally:
+                    window_semaphore.release()
+                    progress.update(len(day_strs))
+
+            # windows are listed one after another since their size adapts to
+            # the previous listing, while details are fetched in the background
+            # as soon as their page is in
+            tasks = []
+            complete = True
+            for day_strs, unlisted in self.listing_windows(days):
+                await window_semaphore.acquire()
+                listed = True
+                fetches = []
+                fetched = set()
+                if unlisted:
+                    pages = self.list_window(day_strs)
+                    while True:
+                        page = await call(
+                            'changes from %s to %s' % (day_strs[0], day_strs[-1]),
+                            next, pages, None)
+                        if page is None:
+                            break
+                        if isinstance(page, Exception):
+                            self.fail_window(day_strs)
+                            self.retry_later(('window', tuple(day_strs)), page)
+                            listed = complete = False
+                            break
+                        for day_str, change_number in page:
+                            await fetch_semaphore.acquire()
+                            fetched.add(change_number)
+                            fetches.append(asyncio.ensure_future(
+                                fetch(day_str, change_number)))
+                tasks.append(asyncio.ensure_future(
+                    crawl_days(day_strs, listed, fetches, fetched)))
+
+            results = await asyncio.gather(*tasks)
+            progress.close()
+
+            # a retried window is listed and fetched by crawl_window in one
+            # worker thread
+            while self.retries:
+                await asyncio.sleep(self.retries.wait_time())
+                await asyncio.gather(*[
+                    call(self.describe(unit), self.retry, unit)
+                    for unit in self.retries.pop_due()])
+            return complete and all(results)
+
+    def run_async(self):
+        self.create_day_paths()
+
+        days_pending = self.manifest.pending_days()
+        self.log.info(
+            'Started async crawl of %i pending days with concurrency %i' % (
+                len(days_pending), self.concurrency))
+
+        asyncio.run(self.crawl_async(days_pending))
+
+        self.finish_run()
+
+    def refresh_changes(self, since):
+        until = datetime.datetime.utcnow()
+        changes = self.list_changes(since, until)
+
+        # days run() would list up to the end date are covered by this
+        # listing already
+        day = datetime.datetime(since.year, since.month, since.day)
+        days = []
+        while day < self.end_date:
+            days.append(day.strftime('%Y-%m-%d'))
+            day += datetime.timedelta(days=1)
+        self.manifest.add_days(days, Manifest.LISTED)
+
+        changes_by_day = {}
+        for change in changes:
+            day_str = self.manifest.change_day(change['_number'])
+            if day_str is None:
+                day_str = max(change['updated'][:10], since.strftime('%Y-%m-%d'))
+            changes_by_day.setdefault(day_str, []).append(change)
+        self.manifest.add_days(list(changes_by_day), Manifest.LISTED)
+        # refreshed changes go to the server, also those stored without an
+        # ETag that get_change could revalidate
+        if self.cache is not None:
+            self.cache.invalidate([self.change_url(change['_number']) for change in changes])
+        for day_str, day_changes in changes_by_day.items():
+            self.storage.prepare_day(os.path.join(
+                self.directory, 'changes', day_str))
+            self.manifest.refresh_changes(
+                day_str, [change['_number'] for change in day_changes])
+            if self.batch:
+                self.store_batch(day_str, day_changes)
+
+        self.log.info('%i changes were updated since %s' % (
+            len(changes), datetime_to_string(since)))
+        return max([parse_gerrit_timestamp(change['updated']) for change in changes] + [since])
+
+    def run_incremental(self, run):
+        # the high-water mark is the latest updated timestamp seen; as
+        # after: is inclusive, changes on the mark are listed again, but
+        # their ETag makes refetching them cheap
+        self.manifest = self.open_manifest()
+        high_water_mark = self.manifest.get_state('high_water_mark')
+
+        if high_water_mark is None:
+            self.log.info('No high-water mark yet, crawling until %s' %
+                     datetime_to_string(self.end_date))
+            high_water_mark = self.end_date
+        else:
+            try:
+                high_water_mark = self.refresh_changes(
+                    parse_gerrit_timestamp(high_water_mark))
+            except Exception as exception:
+                self.handle_exception(exception, 'changes since ' + high_water_mark)
+                return
+        run()
+        # run closes the manifest when it forks workers
+        if self.manifest is None:
+            self.manifest = self.open_manifest()
+        self.manifest.set_state(
+            'high_water_mark', datetime_to_string(high_water_mark))
 
-                change_numbers += [change['_number'] for change in changes]
+    def close(self):
+        # SQLite connections must not be carried over into forked processes
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        self.storage.close()
+        if self.cache is not None:
+            self.cache.close()
 
-                for change_number in change_numbers:
-                    try:
-                        self.get_change(change_number, day_path)
-                    except Exception as exception:
-                        Gerry.handle_exception(
-                            exception, 'change ' + str(change_number))
-                        complete = False
+    def run_worker(self, owner, claim_size=32, lease_seconds=600):
+        self.metrics.file_name = 'metrics-' + owner.replace(':', '-')
+        self.dead_letters_file_name = 'dead_letters-%s.json' % owner.replace(':', '-')
+        self.create_day_paths()
+
+        # a heartbeat renews the leases however long a busy or throttled
+        # window or the backoffs of its retries take
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=self.renew_leases, daemon=True,
+                                     args=(owner, lease_seconds, stopped))
+        heartbeat.start()
+        try:
+            # days still pending after their retries are not claimed again
+            given_up = set()
+            while True:
+                days = self.manifest.claim_days(
+                    owner, claim_size, lease_seconds, given_up)
+                if not days:
+                    if not [day for day, _ in self.manifest.pending_days()
+                            if day not in given_up]:
+                        break
+                    # the remaining days are leased by other workers, wait
+                    # until they are done or their leases expire
+                    time.sleep(min(lease_seconds, 30))
+                    continue
+
+                self.log.info('Worker %s claimed %i days from %s to %s' % (
+                    owner, len(days), days[0][0], days[-1][0]))
+                for day_strs, unlisted in self.listing_windows(days):
+                    self.crawl_window(day_strs, unlisted)
+                    self.retry_due()
+                self.retry_due(wait=True)
+                pending_days = {day for day, _ in self.manifest.pending_days()}
+                given_up.update(day for day, _ in days if day in pending_days)
+                self.manifest.release_days(owner)
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+        self.finish_run()
+
+    def renew_leases(self, owner, lease_seconds, stopped):
+        while not stopped.wait(lease_seconds / 4):
+            try:
+                self.manifest.renew_days(owner, lease_seconds)
+            except sqlite3.Error as error:
+                # the next beat tries again well before the leases expire
+                self.log.warning('Renewing the leases of %s failed: %s' % (
+                    owner, error))
+
+
+def run_worker(create_gerry):
+    create_gerry().run_worker('%s:%i' % (socket.gethostname(), os.getpid()))
+
+
+def run_workers(create_gerry, count):
+    # Forked workers build their own Gerry, so that no SQLite connection is
+    # shared between processes. The manifest and its days are created once
+    # before forking, so that the workers only open it.
+    gerry = create_gerry()
+    gerry.create_day_paths()
+    gerry.close()
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker, args=(create_gerry,))
+                 for _ in range(count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [process for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError('%i of %i workers of %s failed with exit codes %s' % (
+            len(failed), count, gerry.name,
+            ', '.join(str(process.exitcode) for process in failed)))
+
+
+def select_instances(argument, names):
+    if argument == 'all':
+        return list(names)
+    selected = argument.split(',')
+    unknown = [name for name in selected if name not in names]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            'unknown instances: %s' % ', '.join(unknown))
+    return selected
+
+
+def run_instances(gerries, run_instance):
+    # One thread per instance, each with its own rate controller and
+    # concurrency cap. A throttled instance waits on its own controller before
+    # it takes from the shared budget, which leaves the budget to the others.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(gerries)) as executor:
+        futures = {executor.submit(run_instance, gerry): gerry
+                   for gerry in gerries}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as exception:
+                log.exception('Crawling %s failed: %s' % (
+                    futures[future].name, exception))
 
 
 if __name__ == '__main__':
@@ -167,17 +1283,101 @@ if __name__ == '__main__':
     }
 
     parser = argparse.ArgumentParser('gerry')
-    parser.add_argument('gerry_instance', choices=list(data))
+    parser.add_argument('gerry_instance',
+                        help="one of %s, a comma separated list of them or 'all'" % ', '.join(data))
     parser.add_argument('--directory', dest='directory',
                         default='./gerry_data/')
+    parser.add_argument('--mode', dest='mode', choices=['sync', 'async'],
+                        default='sync')
+    parser.add_argument('--concurrency', dest='concurrency', type=int,
+                        default=8)
+    parser.add_argument('--rate', dest='rate', type=float, default=5.0,
+                        help='initial requests per second')
+    parser.add_argument('--page-size', dest='page_size', type=int,
+                        default=250)
+    parser.add_argument('--storage', dest='storage',
+                        choices=['files', 'shards'], default='files',
+                        help='one JSON file per change or compressed monthly shards')
+    parser.add_argument('--raw', dest='raw', action='store_true',
+                        help='store change details as received without parsing them')
+    parser.add_argument('--batch', dest='batch', action='store_true',
+                        help='take change details from the list queries instead of one request per change')
+    parser.add_argument('--budget', dest='budget', type=float, default=None,
+                        help='requests per second shared by all instances, or split evenly between '
+                        'the worker processes of one host')
+    parser.add_argument('--workers', dest='workers', type=int, default=0,
+                        help='crawl one instance with this many worker processes that lease days from the manifest, '
+                        'start it on several hosts sharing the directory to scale out')
+    parser.add_argument('--incremental', dest='incremental',
+                        action='store_true',
+                        help='only refetch changes updated since the last run')
+    parser.add_argument('--cache-size', dest='cache_size', type=int,
+                        default=None,
+                        help='keep up to this many MB of change details in a response cache')
+    parser.add_argument('--intern-accounts', dest='intern_accounts',
+                        action='store_true',
+                        help='store accounts once in accounts.sqlite instead of in every change')
     args = parser.parse_args()
+    try:
+        instances = select_instances(args.gerry_instance, data)
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+    if args.workers and len(instances) > 1:
+        # workers are forked from the main thread; forking from the threads
+        # of several instances could copy held locks into the children
+        parser.error('--workers crawls a single instance')
 
     print(args.directory)
 
     os.makedirs(args.directory, exist_ok=True)
 
-    gerry = Gerry(args.gerry_instance, data[args.gerry_instance]['url'],
-                  data[args.gerry_instance]['start_datetime'], datetime.datetime(2018, 7, 1), args.directory)
-    config_logging(gerry.directory)
+    end_datetime = datetime.datetime(2018, 7, 1)
+    if args.incremental:
+        end_datetime = datetime.datetime.combine(
+            datetime.datetime.utcnow().date(), datetime.time())
+
+    budget = None
+    if args.budget:
+        # every worker process gets its own copy of the budget, so each
+        # takes its share of it
+        rate = args.budget / max(args.workers, 1)
+        budget = RateController('budget', rate=rate, max_rate=rate, increase=0)
+
+    gerries = []
+    create_gerries = {}
+    for instance in instances:
+        create_gerries[instance] = functools.partial(
+            Gerry, instance, data[instance]['url'],
+            data[instance]['start_datetime'], end_datetime, args.directory,
+            args.concurrency, args.rate, args.page_size, storage=args.storage,
+            raw=args.raw, batch=args.batch, budget=budget,
+            cache_size=args.cache_size, intern_accounts=args.intern_accounts)
+        gerry = create_gerries[instance]()
+        if len(instances) == 1:
+            config_logging(gerry.directory)
+        else:
+            config_logging(gerry.directory, gerry.log)
+        gerries.append(gerry)
+    if len(instances) > 1:
+        config_logging(args.directory)
+
+    def run_instance(gerry):
+        if args.workers:
+            # the changes updated since the last run are listed once here,
+            # the workers lease their days from the manifest
+            def run():
+                gerry.close()
+                run_workers(create_gerries[gerry.name], args.workers)
+        elif args.mode == 'async':
+            run = gerry.run_async
+        else:
+            run = gerry.run
+        if args.incremental:
+            gerry.run_incremental(run)
+        else:
+            run()
 
-    gerry.run()
+    if args.workers:
+        run_instance(gerries[0])
+    else:
+        run_instances(gerries, run_instance)
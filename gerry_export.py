@@ -0,0 +1,199 @@
+import argparse
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+
+import gerry_storage
+
+
+# Flattens the crawled changes of an instance into tables stored column by
+# column: <instance>/export/<table>/<month>/<column>.json.gz holds one JSON
+# array per column and month, like the monthly shards of ShardStorage. A
+# month is only exported again when the version of one of its days in the
+# storage changed, partitions.json keeps the exported versions.
+
+TABLES = {
+    'changes': ['change', 'day', 'project', 'branch', 'change_id', 'subject',
+                'status', 'owner', 'created', 'updated', 'submitted',
+                'insertions', 'deletions', 'revisions', 'messages'],
+    'revisions': ['change', 'revision', 'patch_set', 'kind', 'created',
+                  'uploader'],
+    'files': ['change', 'patch_set', 'path', 'status', 'lines_inserted',
+              'lines_deleted'],
+    'messages': ['change', 'id', 'patch_set', 'author', 'date', 'message'],
+    'reviewers': ['change', 'account', 'state', 'added'],
+    'labels': ['change', 'label', 'account', 'value', 'date'],
+}
+
+
+# accounts are exported by their _account_id only, so the export reads
+# changes stored with interned accounts as they are
+def account_id(account):
+    if not account:
+        return None
+    return account.get('_account_id')
+
+
+def flatten_change(change, day, rows):
+    number = change['_number']
+    rows['changes'].append([
+        number, day, change.get('project'), change.get('branch'),
+        change.get('change_id'), change.get('subject'), change.get('status'),
+        account_id(change.get('owner')), change.get('created'),
+        change.get('updated'), change.get('submitted'),
+        change.get('insertions'), change.get('deletions'),
+        len(change.get('revisions', {})), len(change.get('messages', []))])
+
+    for revision, details in change.get('revisions', {}).items():
+        patch_set = details.get('_number')
+        rows['revisions'].append([
+            number, revision, patch_set, details.get('kind'),
+            details.get('created'), account_id(details.get('uploader'))])
+        for path, file_details in details.get('files', {}).items():
+            rows['files'].append([
+                number, patch_set, path, file_details.get('status', 'M'),
+                file_details.get('lines_inserted', 0),
+                file_details.get('lines_deleted', 0)])
+
+    for message in change.get('messages', []):
+        rows['messages'].append([
+            number, message.get('id'), message.get('_revision_number'),
+            account_id(message.get('author')), message.get('date'),
+            message.get('message')])
+
+    # the first time a reviewer was added, if the server reports updates
+    added = {}
+    for update in change.get('reviewer_updates', []):
+        reviewer = account_id(update.get('reviewer'))
+        if reviewer not in added:
+            added[reviewer] = update.get('updated')
+    for state, accounts in change.get('reviewers', {}).items():
+        for account in accounts:
+            rows['reviewers'].append([
+                number, account_id(account), state,
+                added.get(account_id(account))])
+
+    for label, details in change.get('labels', {}).items():
+        for vote in details.get('all', []):
+            rows['labels'].append([
+                number, label, account_id(vote), vote.get('value'),
+                vote.get('date')])
+
+
+def write_columns(directory, columns, rows):
+    # write to a temporary directory and swap it in, so that readers never
+    # see a partial partition
+    temp_directory = directory + '.tmp'
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+    for i, column in enumerate(columns):
+        with gzip.open(os.path.join(temp_directory, column + '.json.gz'), 'wt') as column_file:
+            json.dump([row[i] for row in rows], column_file)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temp_directory, directory)
+
+
+def month_version(storage, days):
+    version = hashlib.sha1()
+    for day in days:
+        version.update(('%s %s\n' % (day, storage.day_version(day))).encode())
+    return version.hexdigest()
+
+
+def export_month(storage_name, directory, export_directory, month, days):
+    storage = gerry_storage.create_storage(storage_name, directory)
+    try:
+        # the version is taken before reading, so that a change written in
+        # the meantime makes the month stale for the next export
+        version = month_version(storage, days)
+        rows = {table: [] for table in TABLES}
+        for day in days:
+            for _, change in storage.iter_day(day):
+                flatten_change(change, day, rows)
+    finally:
+        storage.close()
+    for table, columns in TABLES.items():
+        write_columns(os.path.join(export_directory, table, month), columns,
+                      rows[table])
+    return month, version, len(rows['changes'])
+
+
+def read_partitions(export_directory):
+    try:
+        with open(os.path.join(export_directory, 'partitions.json')) as partitions_file:
+            return json.load(partitions_file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_partitions(export_directory, partitions):
+    file_name = os.path.join(export_directory, 'partitions.json')
+    with open(file_name + '.tmp', 'w') as partitions_file:
+        json.dump(partitions, partitions_file, indent=2, sort_keys=True)
+    os.replace(file_name + '.tmp', file_name)
+
+
+def export(directory, storage_name='files', processes=None):
+    # returns the exported months; months whose version did not change since
+    # the last export are skipped and months that are gone are removed
+    export_directory = os.path.join(directory, 'export')
+    os.makedirs(export_directory, exist_ok=True)
+    partitions = read_partitions(export_directory)
+
+    storage = gerry_storage.create_storage(storage_name, directory)
+    try:
+        days_by_month = {}
+        for day in storage.days():
+            days_by_month.setdefault(day[:7], []).append(day)
+        stale_months = [month for month, days in sorted(days_by_month.items())
+                        if partitions.get(month) != month_version(storage, days)]
+    finally:
+        storage.close()
+
+    # also removes the day partitions of earlier exports
+    for month in set(partitions) - set(days_by_month):
+        for table in TABLES:
+            shutil.rmtree(os.path.join(export_directory, table, month),
+                          ignore_errors=True)
+        del partitions[month]
+
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes) as pool:
+        results = pool.starmap(export_month, [
+            (storage_name, directory, export_directory, month, days_by_month[month])
+            for month in stale_months])
+    for month, version, _ in results:
+        partitions[month] = version
+    write_partitions(export_directory, partitions)
+    return stale_months
+
+
+def read_table(directory, table, columns=None, months=None):
+    # {column: values} of an exported table, reading only the given columns
+    # of the given months
+    export_directory = os.path.join(directory, 'export')
+    columns = columns or TABLES[table]
+    result = {column: [] for column in columns}
+    for month in sorted(months or read_partitions(export_directory)):
+        for column in columns:
+            with gzip.open(os.path.join(export_directory, table, month, column + '.json.gz'), 'rt') as column_file:
+                result[column] += json.load(column_file)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('gerry_export')
+    parser.add_argument('directory',
+                        help='instance directory, e.g. ./gerry_data/gerrit')
+    parser.add_argument('--storage', dest='storage',
+                        choices=['files', 'shards'], default='files')
+    parser.add_argument('--processes', dest='processes', type=int,
+                        default=None, help='number of CPUs by default')
+    args = parser.parse_args()
+
+    months = export(args.directory, args.storage, args.processes)
+    print('Exported %i months to %s' % (
+        len(months), os.path.join(args.directory, 'export')))
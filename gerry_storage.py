@@ -0,0 +1,465 @@
+import argparse
+import fcntl
+import glob
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import tqdm
+
+
+# A day is identified by its folder path, <instance>/changes/<day>, as in
+# Gerry.get_change; storages that do not keep one file per change only use
+# the folder name.
+
+
+class DirectoryStorage(object):
+    # one uncompressed <number>.json file per change in its day folder
+    def __init__(self, directory):
+        self.directory = directory
+
+    def prepare_day(self, folder):
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, folder, change_number, change):
+        file_name = str(change_number) + '.json'
+        with open(os.path.join(folder, file_name), 'w') as json_file:
+            json.dump(change, json_file)
+
+    def write_raw(self, folder, change_number, payload):
+        file_name = str(change_number) + '.json'
+        with open(os.path.join(folder, file_name), 'wb') as json_file:
+            json_file.write(payload)
+
+    def read_raw(self, change_number):
+        file_names = glob.glob(os.path.join(
+            self.directory, 'changes', '*', str(change_number) + '.json'))
+        if not file_names:
+            raise KeyError(change_number)
+        with open(file_names[0], 'rb') as json_file:
+            return json_file.read()
+
+    def read(self, change_number):
+        return json.loads(self.read_raw(change_number))
+
+    def iter_changes(self):
+        for folder in sorted(glob.glob(os.path.join(self.directory, 'changes', '*'))):
+            for file_name in sorted(os.listdir(folder)):
+                if not file_name.endswith('.json'):
+                    continue
+                with open(os.path.join(folder, file_name)) as json_file:
+                    yield folder, int(file_name[:-5]), json.load(json_file)
+
+    def days(self):
+        return sorted(os.path.basename(folder) for folder in glob.glob(
+            os.path.join(self.directory, 'changes', '*')))
+
+    def day_file_names(self, day):
+        folder = os.path.join(self.directory, 'changes', day)
+        return sorted(os.path.join(folder, file_name) for file_name in os.listdir(folder)
+                      if file_name.endswith('.json'))
+
+    def day_version(self, day):
+        # changes when a change of the day is added, rewritten or removed
+        version = hashlib.sha1()
+        for file_name in self.day_file_names(day):
+            stat = os.stat(file_name)
+            version.update(('%s %i %i\n' % (
+                os.path.basename(file_name), stat.st_size, stat.st_mtime_ns)).encode())
+        return version.hexdigest()
+
+    def iter_day(self, day):
+        for file_name in self.day_file_names(day):
+            with open(file_name, 'rb') as json_file:
+                yield int(os.path.basename(file_name)[:-5]), json.load(json_file)
+
+    def close(self):
+        pass
+
+
+class ShardStorage(object):
+    # Changes are appended to gzip compressed JSON lines shards, one gzip
+    # member per change, so that a shard can be read with zcat as a whole and
+    # a single change can be decompressed from its offset. An SQLite index maps
+    # change numbers to shard, offset and length. Rewriting a change appends
+    # it again and moves the index entry, the old bytes stay as garbage.
+    # The granularity of the shards is kept in the index, an existing index
+    # keeps the granularity it was created with.
+    def __init__(self, directory, granularity=None):
+        self.directory = directory
+        self.shard_directory = os.path.join(directory, 'shards')
+        self.lock = threading.Lock()
+        os.makedirs(self.shard_directory, exist_ok=True)
+        self.connection = sqlite3.connect(
+            os.path.join(self.shard_directory, 'index.sqlite'), timeout=60,
+            check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS changes (number INTEGER PRIMARY KEY, day TEXT NOT NULL, shard TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS changes_shard_offset ON changes (shard, offset)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'granularity'").fetchone()
+            if row is None:
+                # indexes from before the meta table tell by their shard names
+                row = self.connection.execute(
+                    'SELECT shard FROM changes LIMIT 1').fetchone()
+                stored = None
+                if row is not None:
+                    stored = 'day' if len(row[0].split('.')[0]) == 10 else 'month'
+                self.connection.execute(
+                    "INSERT INTO meta VALUES ('granularity', ?)",
+                    (stored or granularity or 'month',))
+            else:
+                stored = row[0]
+        if granularity is not None and stored is not None and granularity != stored:
+            self.connection.close()
+            raise ValueError('%s is sharded by %s, not by %s' % (
+                self.shard_directory, stored, granularity))
+        self.granularity = stored or granularity or 'month'
+        self.key_length = 7 if self.granularity == 'month' else 10
+
+    def prepare_day(self, folder):
+        pass
+
+    def write(self, folder, change_number, change):
+        self.write_raw(folder, change_number, json.dumps(change).encode())
+
+    def write_raw(self, folder, change_number, payload):
+        day = os.path.basename(os.path.normpath(folder))
+        shard = day[:self.key_length] + '.jsonl.gz'
+        member = gzip.compress(payload.rstrip() + b'\n', compresslevel=6)
+        with self.lock:
+            with open(os.path.join(self.shard_directory, shard), 'ab') as shard_file:
+                # other worker processes may append to the same shard
+                fcntl.flock(shard_file, fcntl.LOCK_EX)
+                offset = shard_file.seek(0, os.SEEK_END)
+                shard_file.write(member)
+                shard_file.flush()
+                fcntl.flock(shard_file, fcntl.LOCK_UN)
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?)',
+                    (change_number, day, shard, offset, len(member)))
+
+    def read_member(shard_file, offset, length):
+        shard_file.seek(offset)
+        return json.loads(gzip.decompress(shard_file.read(length)))
+
+    def read_raw(self, change_number):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT shard, offset, length FROM changes WHERE number = ?',
+                (change_number,)).fetchone()
+        if row is None:
+            raise KeyError(change_number)
+        shard, offset, length = row
+        with open(os.path.join(self.shard_directory, shard), 'rb') as shard_file:
+            shard_file.seek(offset)
+            return gzip.decompress(shard_file.read(length))
+
+    def read(self, change_number):
+        return json.loads(self.read_raw(change_number))
+
+    def iter_changes(self):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT day, number, shard, offset, length FROM changes ORDER BY shard, offset').fetchall()
+        shard_file = None
+        for day, change_number, shard, offset, length in rows:
+            if shard_file is None or shard_file.name != os.path.join(self.shard_directory, shard):
+                if shard_file is not None:
+                    shard_file.close()
+                shard_file = open(os.path.join(self.shard_directory, shard), 'rb')
+            yield os.path.join(self.directory, 'changes', day), change_number, \
+                ShardStorage.read_member(shard_file, offset, length)
+        if shard_file is not None:
+            shard_file.close()
+
+    def days(self):
+        with self.lock:
+            return [day for day, in self.connection.execute(
+                'SELECT DISTINCT day FROM changes ORDER BY day')]
+
+    def day_rows(self, day):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT number, shard, offset, length FROM changes WHERE day = ? ORDER BY number',
+                (day,)).fetchall()
+
+    def day_version(self, day):
+        # rewritten changes are appended, so their offset moves
+        version = hashlib.sha1()
+        for row in self.day_rows(day):
+            version.update(('%i %s %i %i\n' % row).encode())
+        return version.hexdigest()
+
+    def iter_day(self, day):
+        shard_file = None
+        for change_number, shard, offset, length in self.day_rows(day):
+            if shard_file is None or shard_file.name != os.path.join(self.shard_directory, shard):
+                if shard_file is not None:
+                    shard_file.close()
+                shard_file = open(os.path.join(self.shard_directory, shard), 'rb')
+            yield change_number, ShardStorage.read_member(shard_file, offset, length)
+        if shard_file is not None:
+            shard_file.close()
+
+    def close(self):
+        self.connection.close()
+
+
+def normalize_url(url):
+    # the same request with its query parameters in a different order, a
+    # trailing slash or an upper case host is the same cache entry
+    url = urllib.parse.urlsplit(url)
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(
+        url.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((url.scheme.lower(), url.netloc.lower(),
+                                    url.path.rstrip('/'), query, ''))
+
+
+class ResponseCache(object):
+    # Response payloads on disk keyed on the normalized request URL, with
+    # least recently used entries evicted above max_bytes. Closed changes do
+    # not change anymore and are immutable entries that never expire, any
+    # other entry expires ttl seconds after it was stored.
+    def __init__(self, path, max_bytes=1024 ** 3, ttl=24 * 60 * 60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60,
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, payload BLOB NOT NULL, etag TEXT, size INTEGER NOT NULL, immutable INTEGER NOT NULL, stored_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+            self.size = self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, url):
+        # (payload, etag) or None
+        url = normalize_url(url)
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT payload, etag, immutable, stored_at FROM responses WHERE url = ?',
+                (url,)).fetchone()
+            if row is not None and not row[2] and row[3] + self.ttl < now:
+                self.connection.execute(
+                    'DELETE FROM responses WHERE url = ?', (url,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute(
+                'UPDATE responses SET accessed_at = ? WHERE url = ?', (now, url))
+        return row[0], row[1]
+
+    def put(self, url, payload, etag=None, immutable=False):
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (url, payload, etag, size, immutable, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (normalize_url(url), payload, etag, len(payload), int(immutable), now, now))
+            self.size += len(payload)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def invalidate(self, urls):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM responses WHERE url = ?',
+                                        [(normalize_url(url),) for url in urls])
+
+    def evict(self):
+        # other processes may share the cache, so count again before evicting
+        # down to 90% of max_bytes
+        self.size = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        urls = []
+        for url, size in self.connection.execute(
+                'SELECT url, size FROM responses ORDER BY accessed_at'):
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            urls.append((url,))
+            self.size -= size
+        self.connection.executemany('DELETE FROM responses WHERE url = ?', urls)
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'entries': entries, 'bytes': self.size}
+
+    def report(self, logger):
+        stats = self.stats()
+        logger.info('Response cache: %i hits, %i misses (%.0f%% hit rate), %i entries, %.1f MB' % (
+            stats['hits'], stats['misses'], 100.0 * stats['hit_rate'],
+            stats['entries'], stats['bytes'] / 1024.0 ** 2))
+
+    def close(self):
+        self.connection.close()
+
+
+# fields of DETAILED_ACCOUNTS objects that describe the account itself, any
+# other field next to an _account_id, like the value of a vote, belongs to
+# the change
+ACCOUNT_FIELDS = ['name', 'email', 'username', 'display_name', 'avatars',
+                  'secondary_emails', 'status', 'inactive', 'tags']
+
+
+class AccountStorage(object):
+    # Wraps another storage and keeps every account once in
+    # <instance>/accounts.sqlite; stored changes refer to accounts by their
+    # _account_id only. Reads put the account fields back, so readers get the
+    # changes as the server sent them.
+    def __init__(self, storage, directory):
+        self.storage = storage
+        self.directory = directory
+        self.accounts = {}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(directory, 'accounts.sqlite'), timeout=60,
+            check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS accounts (id INTEGER PRIMARY KEY, account TEXT NOT NULL)')
+
+    def intern(self, value, accounts):
+        if isinstance(value, dict):
+            if '_account_id' in value:
+                fields = {key: value[key] for key in ACCOUNT_FIELDS if key in value}
+                if fields:
+                    accounts.setdefault(value['_account_id'], {}).update(fields)
+                return {key: self.intern(item, accounts) for key, item in value.items()
+                        if key not in fields}
+            return {key: self.intern(item, accounts) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.intern(item, accounts) for item in value]
+        return value
+
+    def rehydrate(self, value):
+        if isinstance(value, dict):
+            value = {key: self.rehydrate(item) for key, item in value.items()}
+            if '_account_id' in value:
+                account = {'_account_id': value['_account_id']}
+                account.update(self.account(value['_account_id']))
+                account.update(value)
+                return account
+            return value
+        if isinstance(value, list):
+            return [self.rehydrate(item) for item in value]
+        return value
+
+    def account(self, account_id):
+        # accounts interned by other worker processes are not cached yet
+        with self.lock:
+            if account_id not in self.accounts:
+                row = self.connection.execute(
+                    'SELECT account FROM accounts WHERE id = ?',
+                    (account_id,)).fetchone()
+                self.accounts[account_id] = json.loads(row[0]) if row else {}
+            return self.accounts[account_id]
+
+    def store_accounts(self, accounts):
+        changed = []
+        for account_id, fields in accounts.items():
+            known = self.account(account_id)
+            if any(known.get(key) != item for key, item in fields.items()):
+                known = dict(known, **fields)
+                changed.append((account_id, json.dumps(known)))
+                with self.lock:
+                    self.accounts[account_id] = known
+        if changed:
+            with self.lock, self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO accounts VALUES (?, ?)', changed)
+
+    def prepare_day(self, folder):
+        self.storage.prepare_day(folder)
+
+    def write(self, folder, change_number, change):
+        accounts = {}
+        change = self.intern(change, accounts)
+        self.store_accounts(accounts)
+        self.storage.write(folder, change_number, change)
+
+    def write_raw(self, folder, change_number, payload):
+        self.write(folder, change_number, json.loads(payload))
+
+    def read_raw(self, change_number):
+        return json.dumps(self.read(change_number)).encode()
+
+    def read(self, change_number):
+        return self.rehydrate(self.storage.read(change_number))
+
+    def iter_changes(self):
+        for folder, change_number, change in self.storage.iter_changes():
+            yield folder, change_number, self.rehydrate(change)
+
+    def days(self):
+        return self.storage.days()
+
+    def day_version(self, day):
+        return self.storage.day_version(day)
+
+    def iter_day(self, day):
+        for change_number, change in self.storage.iter_day(day):
+            yield change_number, self.rehydrate(change)
+
+    def close(self):
+        self.storage.close()
+        self.connection.close()
+
+
+def create_storage(name, directory, intern_accounts=False):
+    if name == 'shards':
+        storage = ShardStorage(directory)
+    else:
+        storage = DirectoryStorage(directory)
+    if intern_accounts:
+        storage = AccountStorage(storage, directory)
+    return storage
+
+
+def convert(source, target):
+    count = 0
+    for folder, change_number, change in tqdm.tqdm(source.iter_changes()):
+        target.write(folder, change_number, change)
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('gerry_storage')
+    parser.add_argument('directory',
+                        help='instance directory, e.g. ./gerry_data/gerrit')
+    parser.add_argument('--granularity', dest='granularity',
+                        choices=['day', 'month'], default=None,
+                        help='shard size of a new index, month by default')
+    parser.add_argument('--intern-accounts', dest='intern_accounts',
+                        action='store_true',
+                        help='keep accounts once in accounts.sqlite')
+    args = parser.parse_args()
+
+    target = ShardStorage(args.directory, args.granularity)
+    if args.intern_accounts:
+        target = AccountStorage(target, args.directory)
+    count = convert(DirectoryStorage(args.directory), target)
+    target.close()
+    print('Converted %i changes to %s' % (
+        count, os.path.join(args.directory, 'shards')))
@@ -0,0 +1,254 @@
+import argparse
+import datetime
+import http.server
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+import gerry_storage
+
+
+# A local stand-in for the Gerrit REST endpoints the crawlers use: change
+# queries with after/before/status, n, S and N paging and detail options,
+# /changes/<n>/detail with ETags and /changes/<n>/comments. Responses carry
+# the )]}' prefix, latency and 429/500/503 errors can be injected.
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+LIST_FIELDS = ['id', 'project', 'branch', 'change_id', 'subject', 'status',
+               'created', 'updated', 'insertions', 'deletions', '_number',
+               'owner']
+
+
+def synthetic_changes(count, start_datetime, days, payload_size=2000,
+                      seed=0):
+    generator = random.Random(seed)
+    changes = []
+    seconds = days * 24 * 60 * 60
+    for i in range(count):
+        number = i + 1
+        updated = start_datetime + datetime.timedelta(
+            seconds=generator.randrange(seconds))
+        created = updated - datetime.timedelta(
+            hours=generator.randrange(1, 240))
+        owner = {'_account_id': 1000000 + generator.randrange(50)}
+        owner['name'] = 'Developer %i' % owner['_account_id']
+        owner['email'] = 'dev%i@example.com' % owner['_account_id']
+        revision_count = generator.randrange(1, 6)
+        revisions = {}
+        for patch_set in range(1, revision_count + 1):
+            revisions['%040x' % (number * 100 + patch_set)] = {
+                '_number': patch_set,
+                'created': created.strftime(TIMESTAMP_FORMAT) + '000',
+                'uploader': owner,
+                'files': {'src/file%i.py' % patch_set: {'lines_inserted': 10}}}
+        changes.append({
+            'id': 'project~master~I%040x' % number,
+            'project': 'project%i' % (number % 7),
+            'branch': 'master',
+            'change_id': 'I%040x' % number,
+            'subject': 'Change %i' % number,
+            'status': 'MERGED' if generator.random() < 0.8 else 'ABANDONED',
+            'created': created.strftime(TIMESTAMP_FORMAT) + '000',
+            'updated': updated.strftime(TIMESTAMP_FORMAT) + '000',
+            'insertions': generator.randrange(1000),
+            'deletions': generator.randrange(1000),
+            '_number': number,
+            'owner': owner,
+            'labels': {'Code-Review': {'all': [dict(owner, value=2)]}},
+            'messages': [{'id': '%i-%i' % (number, j), 'author': owner,
+                          'date': updated.strftime(TIMESTAMP_FORMAT) + '000',
+                          'message': 'x' * (payload_size // 4),
+                          '_revision_number': 1} for j in range(4)],
+            'revisions': revisions,
+            'current_revision': '%040x' % (number * 100 + revision_count)})
+    return changes
+
+
+class MockGerrit(object):
+    def __init__(self, changes, latency=0.0, error_rates=None, retry_after=1,
+                 max_page_size=500, seed=0):
+        self.changes = sorted(changes, key=lambda change: (
+            change['updated'], change['_number']), reverse=True)
+        self.changes_by_number = {
+            change['_number']: change for change in changes}
+        self.latency = latency
+        self.error_rates = error_rates or {}
+        self.retry_after = retry_after
+        self.max_page_size = max_page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.bytes_sent = 0
+        self.server = None
+
+    def from_storage(storage, **kwargs):
+        # replays a crawled instance directory
+        return MockGerrit([change for _, _, change in storage.iter_changes()],
+                          **kwargs)
+
+    def start(self, port=0):
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                mock.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def inject_error(self):
+        with self.lock:
+            for status_code, rate in self.error_rates.items():
+                if self.random.random() < rate:
+                    self.error_count += 1
+                    return status_code
+        return None
+
+    def handle(self, handler):
+        with self.lock:
+            self.request_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        status_code = self.inject_error()
+        if status_code is not None:
+            headers = {}
+            if status_code in (429, 503) and self.retry_after is not None:
+                headers['Retry-After'] = str(self.retry_after)
+            self.respond(handler, status_code, b'Injected error\n', headers)
+            return
+
+        url = urllib.parse.urlsplit(handler.path)
+        parameters = urllib.parse.parse_qs(url.query)
+        path = url.path.rstrip('/')
+        match = re.match(r'.*/changes/(\d+)(/detail|/comments)?$', path)
+        if path.endswith('/changes'):
+            self.respond_json(handler, self.query(parameters))
+        elif match and int(match.group(1)) in self.changes_by_number:
+            change = self.changes_by_number[int(match.group(1))]
+            if match.group(2) == '/comments':
+                self.respond_json(handler, self.comments(change))
+                return
+            etag = '"%i-%s"' % (change['_number'], change['updated'])
+            if handler.headers.get('If-None-Match') == etag:
+                self.respond(handler, 304, b'', {'ETag': etag})
+            else:
+                self.respond_json(handler, change, {'ETag': etag})
+        else:
+            self.respond(handler, 404, b'Not found\n')
+
+    def query(self, parameters):
+        query = parameters.get('q', [''])[0]
+        after = re.search(r'after:\{([^}]*)\}', query)
+        before = re.search(r'before:\{([^}]*)\}', query)
+        status = re.search(r'status:(\w+)', query)
+        changes = self.changes
+        if after:
+            changes = [change for change in changes if change['updated'][:23] >= after.group(1)]
+        if before:
+            changes = [change for change in changes if change['updated'][:23] <= before.group(1)]
+        if status:
+            changes = [change for change in changes if change['status'].lower() == status.group(1).lower()]
+        if 'N' in parameters:
+            sort_key = parameters['N'][0]
+            changes = [change for change in changes if self.sort_key(change) < sort_key]
+
+        offset = int(parameters.get('S', ['0'])[0])
+        limit = min(int(parameters.get('n', [self.max_page_size])[0]), self.max_page_size)
+        page = changes[offset:offset + limit]
+        options = parameters.get('o', [])
+        result = []
+        for change in page:
+            if options:
+                result.append(self.with_revisions(change, options))
+            else:
+                result.append({field: change[field] for field in LIST_FIELDS if field in change})
+            result[-1]['_sortkey'] = self.sort_key(change)
+        if result and offset + limit < len(changes):
+            result[-1]['_more_changes'] = True
+        return result
+
+    def with_revisions(self, change, options):
+        # like Gerrit, list queries only carry the revisions they ask for
+        change = dict(change)
+        if 'CURRENT_REVISION' in options and 'ALL_REVISIONS' not in options:
+            change['revisions'] = {change['current_revision']:
+                                   change['revisions'][change['current_revision']]}
+        elif 'ALL_REVISIONS' not in options:
+            del change['revisions']
+            del change['current_revision']
+        return change
+
+    def sort_key(self, change):
+        # like Gerrit's, keys decrease along the results and N= continues
+        # below the last key
+        return '%016x' % (int(datetime.datetime.strptime(
+            change['updated'][:23], TIMESTAMP_FORMAT).timestamp() * 1000) * 100000 + change['_number'])
+
+    def comments(self, change):
+        comments = {}
+        for revision in change['revisions'].values():
+            for file_name in revision.get('files', {}):
+                comments.setdefault(file_name, []).append({
+                    'patch_set': revision['_number'], 'line': 1,
+                    'author': change['owner'], 'message': 'Nit'})
+        return comments
+
+    def respond_json(self, handler, body, headers=None):
+        self.respond(handler, 200, b")]}'\n" + json.dumps(body).encode(), headers,
+                     'application/json; charset=UTF-8')
+
+    def respond(self, handler, status_code, body, headers=None,
+                content_type='text/plain'):
+        handler.send_response(status_code)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(body)
+        with self.lock:
+            self.bytes_sent += len(body)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('mock_gerrit')
+    parser.add_argument('--port', dest='port', type=int, default=8080)
+    parser.add_argument('--changes', dest='changes', type=int, default=1000)
+    parser.add_argument('--days', dest='days', type=int, default=10)
+    parser.add_argument('--payload-size', dest='payload_size', type=int,
+                        default=2000)
+    parser.add_argument('--latency', dest='latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', dest='error_rate', type=float,
+                        default=0.0, help='rate of each of 429, 500 and 503')
+    parser.add_argument('--replay', dest='replay',
+                        help='serve the changes of a crawled instance directory')
+    args = parser.parse_args()
+
+    error_rates = {429: args.error_rate, 500: args.error_rate, 503: args.error_rate}
+    if args.replay:
+        mock = MockGerrit.from_storage(gerry_storage.DirectoryStorage(args.replay),
+                                       latency=args.latency, error_rates=error_rates)
+    else:
+        mock = MockGerrit(synthetic_changes(args.changes, datetime.datetime(2018, 6, 1),
+                                            args.days, args.payload_size),
+                          latency=args.latency, error_rates=error_rates)
+    print('Serving %i changes on %s' % (len(mock.changes), mock.start(args.port)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
@@ -6,10 +6,13 @@
 
 import pymongo, time, logging
 import requests, json, sys
+import queue, threading
+from pymongo import ReplaceOne
 from multiprocessing import Pool
-from multiprocessing.dummy import Pool as ThreadPool
 import pprint
 
+import gerry
+
 
 # In[2]:
 
@@ -17,9 +20,10 @@ import pprint
 db_name = 'qt_20180801'
 base_url = 'https://codereview.qt-project.org/'
 multiThread_cpu_num = 36
-ACCEPTABLE_ERROR = 10
-connection_error = 0
-max_attempt = 3
+# bounded queues between listing, fetching and writing keep memory flat
+fetch_queue_size = 2 * multiThread_cpu_num
+write_queue_size = 1000
+bulk_write_size = 500
 
 client = pymongo.MongoClient()
 db = client[db_name]
@@ -45,68 +49,141 @@ def replaceMongodbInvalidLetter(jsons):
         jsons_replaced.append(json_replaced)
     return jsons_replaced
 
+def upsertOperations(jsons, keys):
+    # replacing by key instead of inserting makes re-runs idempotent
+    return [ReplaceOne({key: j[key] for key in keys}, j, upsert=True) for j in jsons]
+
+def fetchWorker(fetch_queue, write_queue, detail_retries):
+    while True:
+        task = fetch_queue.get()
+        if task is None:
+            fetch_queue.task_done()
+            break
+        try:
+            det_inl = crawl_detail(*task)
+        except Exception as e:
+            logging.exception('*** Exception occured while crawling change %s ***' % task[0])
+            if not detail_retries.schedule(task, e, 'change %s' % task[0]):
+                logging.error('*** Giving up on change %s ***' % task[0])
+            fetch_queue.task_done()
+            continue
+        if len(det_inl['comments']) != 0:
+            write_queue.put((comments_collection, upsertOperations(
+                replaceMongodbInvalidLetter(det_inl['comments']), ['_number'])))
+        if len(det_inl['inlines']) != 0:
+            write_queue.put((inlines_collection, upsertOperations(
+                replaceMongodbInvalidLetter(det_inl['inlines']), ['_number', 'rev_num'])))
+        fetch_queue.task_done()
+
+def writeWorker(write_queue):
+    # drains the write queue into unordered bulk writes per collection
+    pending = {}
+    finished = False
+    while not finished:
+        item = write_queue.get()
+        if item is None:
+            finished = True
+        else:
+            collection, operations = item
+            pending.setdefault(collection.name, (collection, []))[1].extend(operations)
+        for name in list(pending):
+            collection, operations = pending[name]
+            if len(operations) >= bulk_write_size or finished or write_queue.empty():
+                try:
+                    collection.bulk_write(operations, ordered=False)
+                except pymongo.errors.BulkWriteError as e:
+                    logging.exception('*** Bulk write to %s failed: %s ***' % (name, e.details['writeErrors'][:3]))
+                except pymongo.errors.PyMongoError as e:
+                    # keep draining, a dead writer would block every put()
+                    logging.exception('*** Bulk write of %s operations to %s failed: %s ***' % (len(operations), name, e))
+                del pending[name]
+
+def startPipeline(detail_retries):
+    changes_collection.create_index('_number')
+    comments_collection.create_index('_number')
+    inlines_collection.create_index([('_number', pymongo.ASCENDING), ('rev_num', pymongo.ASCENDING)])
+    fetch_queue = queue.Queue(fetch_queue_size)
+    write_queue = queue.Queue(write_queue_size)
+    fetchers = [threading.Thread(target=fetchWorker, args=(fetch_queue, write_queue, detail_retries))
+                for _ in range(multiThread_cpu_num)]
+    writer = threading.Thread(target=writeWorker, args=(write_queue,))
+    for thread in fetchers + [writer]:
+        thread.start()
+    return fetch_queue, write_queue, fetchers, writer
+
+def retryDetails(fetch_queue, detail_retries):
+    # waits for the fetches in flight, which may fail and schedule retries,
+    # and puts due retries back on the queue until none is left
+    while True:
+        fetch_queue.join()
+        if not detail_retries:
+            return
+        time.sleep(detail_retries.wait_time())
+        for task in detail_retries.pop_due():
+            fetch_queue.put(task)
+
+def stopPipeline(fetch_queue, write_queue, fetchers, writer):
+    for _ in fetchers:
+        fetch_queue.put(None)
+    for fetcher in fetchers:
+        fetcher.join()
+    write_queue.put(None)
+    writer.join()
+
+def splitInlineComments(reviewIdNum, inline_json):
+    # /changes/<n>/comments maps file names to the comments of all patch sets,
+    # each comment carries its patch_set; rebuild one document per revision
+    inline_comments_by_rev = {}
+    for fileKey in inline_json:
+        for inline_comment in inline_json[fileKey]:
+            rev_inline_comments = inline_comments_by_rev.setdefault(inline_comment['patch_set'], {})
+            rev_inline_comments.setdefault(fileKey.replace('.', '_'), []).append(inline_comment)
+    inlines = []
+    for rev_num in sorted(inline_comments_by_rev):
+        inline_json_with_id = {}
+        inline_json_with_id['_number'] = reviewIdNum
+        inline_json_with_id['rev_num'] = rev_num
+        inline_json_with_id['inline_comments'] = inline_comments_by_rev[rev_num]
+        inlines.append(inline_json_with_id)
+    return inlines
+
+def getJson(url):
+    # errors raise, fetchWorker and iterChangePages schedule the retry
+    r = requests.get(url)
+    r.raise_for_status()
+    if not r.text.startswith(")]}'"):
+        raise ValueError('Unexpected response for %s: %s' % (url, r.text[:100]))
+    return json.loads(r.text[4:])
+
 ###
 def crawl_detail(reviewIdNum, latestPatchSetNum):
-    global connection_error
     crawl_url_detail = base_url + "changes/%s/detail" % reviewIdNum
     all_det_inl = {'comments': [], 'inlines': []}
-    for attempt_detail in range(max_attempt):
-        try:
-            r_detail = requests.get(crawl_url_detail)
-            detail_raw = r_detail.text
-            if detail_raw.startswith(")]}'"):
-                detail_json = json.loads(detail_raw[4:])
-                all_det_inl['comments'].append(detail_json)
-
-                # Get the max number of patch set number
-                rev_nums = int(latestPatchSetNum)
-
-                # Get the inline comments for each revision of the change
-                for rev_num in range(1, rev_nums+1):
-#                     print('Latest: %s... rev_num=%s' % (rev_nums, rev_num))
-                    crawl_url_inline = base_url + "changes/%s/revisions/%s/" % (reviewIdNum, rev_num)
-                    for attempt_inline in range(max_attempt):
-                        try:
-                            r_inline = requests.get(crawl_url_inline)
-                            inline_raw = r_inline.text
-                            if inline_raw.startswith(")]}'"):
-                                inline_json = json.loads(inline_raw[4:])
-                                inline_json_replaced = {}
-                                for fileKey in inline_json:
-                                    inline_json_replaced[fileKey.replace('.', '_')] = inline_json[fileKey]
-                                if inline_json != {}:
-                                    inline_json_with_id = {}
-                                    inline_json_with_id['_number'] = reviewIdNum
-                                    inline_json_with_id['rev_num'] = rev_num
-                                    inline_json_with_id['inline_comments'] = inline_json_replaced
-                                    all_det_inl['inlines'].append(inline_json_with_id)
-                            break
-                        except requests.exceptions.RequestException as e:
-                            if attempt_inline == max_attempt - 1:
-                                logging.exception(e)
-                                logging.exception('*** Exception occured while crawling %s ***' % crawl_url_inline)
-            break
-        except requests.exceptions.RequestException as e:
-            if attempt_detail == max_attempt - 1:
-                logging.exception(e)
-                logging.exception('*** Exception occured while crawling %s ***' % crawl_url_detail)
+    detail_json = getJson(crawl_url_detail)
+    all_det_inl['comments'].append(detail_json)
+
+    # Get the inline comments of all revisions of the change at once and
+    # split them by patch set, changes without revision info have no inline
+    # comments
+    if int(latestPatchSetNum) > 0:
+        crawl_url_inline = base_url + "changes/%s/comments" % reviewIdNum
+        inline_json = getJson(crawl_url_inline)
+        all_det_inl['inlines'] += splitInlineComments(reviewIdNum, inline_json)
 
-    if all_det_inl['comments'] == []:
-        logging.warning("*** no detail entry for %s ***" % crawl_url_detail)
     if all_det_inl['inlines'] == []:
         logging.debug("*** no inline comment for %s ***" % crawl_url_detail)
 
     return all_det_inl
 ###
 
-def crawl_new_api(status, numRequests):
+def iterChangePages(status, numRequests, page_retries):
+    # yields the changes page by page, the next page is only requested once
+    # the previous one was consumed
     count_changes = 0
-    global connection_error
     change_json = None
     lastKey = None
     roundIdx= 0
-    count = 0
-    while change_json == None or '_more_changes' in change_json[-1]:
+    while change_json == None or (change_json != [] and '_more_changes' in change_json[-1]):
         roundIdx += 1
         try:
             if lastKey == None:
@@ -118,63 +195,56 @@ def crawl_new_api(status, numRequests):
                 crawl_url_change = base_url + "changes/?q=status:%s&o=ALL_REVISIONS&o=ALL_FILES&o=ALL_COMMITS&o=MESSAGES&o=DETAILED_ACCOUNTS&n=%s&N=%s"   % (status, numRequests, lastKey)
             logging.info('*** Start crawling n=%s, _sortKey=%s (status: %s), %sth round ***' % (count_changes, lastKey, status, roundIdx))
             print('*** Start crawling n=%s, _sortKey=%s (status: %s), %sth round ***' % (count_changes, lastKey, status, roundIdx))
-            r_change = requests.get(crawl_url_change)
-            change_raw = r_change.text
-        except requests.exceptions.RequestException as e:
+            change_json = getJson(crawl_url_change)
+        except Exception as e:
             logging.exception(e)
-            time.sleep(10)
-            connection_error += 1
-            if connection_error > ACCEPTABLE_ERROR:
-                logging.exception("Too many errors when crawling changes (> %s), abort this script." % ACCEPTABLE_ERROR)
+            if not page_retries.schedule(crawl_url_change, e, crawl_url_change):
+                logging.exception("Too many errors when crawling changes, abort this script.")
                 logging.exception("Last crawled: %s" % crawl_url_change)
                 sys.exit(1)
-            else:
-                continue
-
-        if change_raw.startswith(")]}'"):
-            change_json = json.loads(change_raw[4:])
-            count_changes += len(change_json)
-            if len(change_json) > 0:
-                change_json_replaced = [print_dict(j) for j in change_json]
-                changes_collection.insert_many(
-                    replaceMongodbInvalidLetter(change_json_replaced))
+            # pages are listed one after another, so wait for this one
+            time.sleep(page_retries.wait_time())
+            page_retries.pop_due()
+            continue
+
+        count_changes += len(change_json)
+        if len(change_json) > 0:
             lastKey = change_json[-1]['_sortkey']
             #lastKey = None
+            yield [print_dict(j) for j in change_json]
+
+def crawl_new_api(status, numRequests):
+    # failed pages and changes are retried with jittered exponential backoff
+    # until their error class runs out of retries, every status starts over
+    page_retries = gerry.RetryScheduler()
+    detail_retries = gerry.RetryScheduler()
+    fetch_queue, write_queue, fetchers, writer = startPipeline(detail_retries)
+    try:
+        for change_json_replaced in iterChangePages(status, numRequests, page_retries):
+            write_queue.put((changes_collection, upsertOperations(
+                replaceMongodbInvalidLetter(change_json_replaced), ['_number'])))
             reviewIdNums = []
             latestPatchSetNums = []
             for each_change in change_json_replaced:
                 reviewIdNums.append(each_change['_number'])
                 if (len(each_change['revisions'].keys()) > 0):
-                    assert(len(each_change['revisions'].keys()) == 1)
-                    for commitId in each_change['revisions'].keys():
-                        latestPatchSetNums.append(each_change['revisions'][commitId]['_number'])
+                    # ALL_REVISIONS lists every patch set, take the latest
+                    latestPatchSetNums.append(max(revision['_number'] for revision in each_change['revisions'].values()))
                 else: # no revision info
                     latestPatchSetNums.append(0)
                     print('No revision info: %s' % (each_change['_number']))
             if(len(reviewIdNums) != len(latestPatchSetNums)):
                 print('%s %s' % (len(reviewIdNums), len(latestPatchSetNums)))
             assert(len(reviewIdNums) == len(latestPatchSetNums))
-            # MULTITHREADING crawl_detail HERE
-            pool = ThreadPool(multiThread_cpu_num)
-            all_det_inl = []
-            all_det_inl = pool.starmap(crawl_detail, zip(reviewIdNums, latestPatchSetNums))
-            pool.close()
-            pool.join()
-            for det_inl in all_det_inl:
-                if len(det_inl['comments']) != 0:
-                    comments_collection.insert_many(
-                        replaceMongodbInvalidLetter(det_inl['comments']))
-                if len(det_inl['inlines']) != 0:
-                    inlines_collection.insert_many(
-                        replaceMongodbInvalidLetter(det_inl['inlines']))
-        elif change_json == None or change_json == []:
-            logging.exception("There is something wrong while crawling %s. Skip." % crawl_url_change)
-            time.sleep(10)
-            continue
-        else:
-            logging.exception("ERROR::: change_json is weird ::: connection_error = %s" % connection_error)
-            time.sleep(10)
-            continue
+            # MULTITHREADING crawl_detail HERE: the fetch workers keep running
+            # across pages, put() blocks while the queue is full and with it
+            # the request for the next page
+            for task in zip(reviewIdNums, latestPatchSetNums):
+                fetch_queue.put(task)
+        retryDetails(fetch_queue, detail_retries)
+    finally:
+        stopPipeline(fetch_queue, write_queue, fetchers, writer)
+        detail_retries.write_report('dead_letters_%s.json' % status)
 
 
 # In[3]:
@@ -1,9 +1,20 @@
 import datetime
+import glob
+import json
+import multiprocessing
 import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch, mock_open
+from unittest.mock import MagicMock, patch, mock_open
+
+import requests
 
 import gerry
+import gerry_storage
+import mock_gerrit
 
 
 class DatetimeToString(unittest.TestCase):
@@ -17,6 +28,16 @@ class DatetimeToString(unittest.TestCase):
             date), '2018-01-01 20:00:00.000')
 
 
+class StripXssi(unittest.TestCase):
+    def test_strip_xssi(self):
+        self.assertEqual(gerry.strip_xssi(b")]}'\n{\"_number\": 1}\n"),
+                         b'{"_number": 1}')
+
+    def test_strip_xssi_truncated(self):
+        self.assertRaises(ValueError, gerry.strip_xssi,
+                          b")]}'\n{\"_number\": 1")
+
+
 class CreateTimeFrames(unittest.TestCase):
     def test_create_time_frames_year(self):
         start_date = datetime.datetime(2017, 1, 1)
@@ -33,20 +54,72 @@ class CreateTimeFrames(unittest.TestCase):
         self.assertEqual(len(timeframes), 24)
 
 
+def mock_response(status_code, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    return response
+
+
+class RateController(unittest.TestCase):
+    def test_parse_retry_after(self):
+        self.assertEqual(gerry.parse_retry_after(
+            mock_response(429, {'Retry-After': '7'})), 7)
+        self.assertIsNone(gerry.parse_retry_after(mock_response(429)))
+        self.assertEqual(gerry.parse_retry_after(mock_response(
+            429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})), 0)
+
+    def test_additive_increase(self):
+        controller = gerry.RateController('gerrit', rate=2.0, increase=1.0)
+        for _ in range(4):
+            controller.on_response(mock_response(200))
+        self.assertGreater(controller.rate, 3.0)
+        self.assertEqual(controller.peak_rate, controller.rate)
+
+    def test_multiplicative_decrease_honors_retry_after(self):
+        controller = gerry.RateController('gerrit', rate=8.0)
+        controller.on_response(mock_response(429, {'Retry-After': '2'}))
+        self.assertEqual(controller.rate, 4.0)
+        self.assertEqual(controller.throttle_count, 1)
+        self.assertGreater(controller.blocked_until, time.monotonic() + 1)
+
+    def test_server_error_pauses_without_slowing_down(self):
+        controller = gerry.RateController('gerrit', rate=8.0)
+        controller.on_response(mock_response(500))
+        self.assertEqual(controller.rate, 8.0)
+        self.assertGreater(controller.blocked_until, time.monotonic())
+
+    def test_acquire_paces_requests(self):
+        controller = gerry.RateController('gerrit', rate=50.0, burst=1)
+        start = time.monotonic()
+        for _ in range(6):
+            controller.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
 class Gerry(unittest.TestCase):
 
-    @patch('os.makedirs')
-    def setUp(self, mock_makedirs):
-        mock_makedirs.return_value = True
-        self.gerry = gerry.Gerry('gerrit', 'https://gerrit-review.googlesource.com',
-                                 datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 2), './gerry_data/')
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.changes = mock_gerrit.synthetic_changes(
+            30, datetime.datetime(2018, 6, 1), 2, payload_size=40)
+        self.mock = mock_gerrit.MockGerrit(self.changes, retry_after=0)
+        self.gerry = gerry.Gerry('gerrit', self.mock.start(),
+                                 datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 2), self.temp_dir.name)
+
+    def tearDown(self):
+        self.mock.stop()
+        self.temp_dir.cleanup()
+
+    def changes_of_day(self, day_str):
+        return [change for change in self.mock.changes if change['updated'][:10] == day_str]
 
     def test_get_changes(self):
         changes = self.gerry.get_changes(
             datetime.datetime.strptime('2018-06-01', '%Y-%m-%d'))
-        self.assertEqual(len(changes), 21)
-        self.assertEqual(changes[0]['change_id'],
-                         'Ib051dd347eaea2c77ae6c403ebf76bed4b9b4b9c')
+        expected = self.changes_of_day('2018-06-01')
+        self.assertEqual(len(changes), len(expected))
+        self.assertEqual(changes[0]['change_id'], expected[0]['change_id'])
 
     def test_get_changes_no_data(self):
         changes = self.gerry.get_changes(
@@ -56,28 +129,612 @@ class Gerry(unittest.TestCase):
     @patch('json.dump')
     @patch("builtins.open", new_callable=mock_open)
     def test_get_change(self, mock_file, mock_dump):
-        self.gerry.get_change(109611, 'folder')
-        mock_file.assert_any_call(os.path.join('folder', '109611.json'), 'w')
+        self.gerry.get_change(7, 'folder')
+        mock_file.assert_any_call(os.path.join('folder', '7.json'), 'w')
         self.assertEqual(
-            mock_dump.call_args[0][0]['change_id'], 'Ic7bc5ad2e57eef27b0d2e13523be78e8a2d0a65c')
+            mock_dump.call_args[0][0]['change_id'], self.changes[6]['change_id'])
+
+    @patch('gerry.Gerry.get')
+    def test_get_raw_change(self, mock_get):
+        mock_get.return_value = mock_response(200, {'ETag': '"1"'})
+        mock_get.return_value.content = b")]}'\n{\"_number\": 109611}\n"
+        self.gerry.raw = True
+        self.gerry.storage = MagicMock()
+
+        self.assertEqual(self.gerry.get_change(109611, 'folder'), '"1"')
+        self.gerry.storage.write_raw.assert_called_once_with(
+            'folder', 109611, b'{"_number": 109611}')
+
+    def test_run(self):
+        day_paths = [os.path.join(self.gerry.directory, 'changes', '2018-06-01'),
+                     os.path.join(self.gerry.directory, 'changes', '2018-06-02')]
+        with patch('gerry.Gerry.get_change', return_value=None) as mock_get_change:
+            self.gerry.end_date = datetime.datetime(2018, 6, 3)
+            self.gerry.run()
+        for day_path in day_paths:
+            for change in self.changes_of_day(os.path.basename(day_path)):
+                mock_get_change.assert_any_call(change['_number'], day_path, None)
+        self.assertEqual(mock_get_change.call_count, len(self.changes))
+
+
+class RetryScheduler(unittest.TestCase):
+    def test_error_class(self):
+        error_class = gerry.RetryScheduler.error_class
+        self.assertEqual(error_class(requests.exceptions.HTTPError(response=mock_response(429))), 'throttled')
+        self.assertEqual(error_class(requests.exceptions.HTTPError(response=mock_response(500))), 'server')
+        self.assertEqual(error_class(requests.exceptions.HTTPError(response=mock_response(404))), 'client')
+        self.assertEqual(error_class(requests.exceptions.ConnectionError()), 'connection')
+        self.assertEqual(error_class(json.JSONDecodeError('', '', 0)), 'parse')
+        self.assertEqual(error_class(Exception()), 'other')
+
+    def test_backoff(self):
+        retries = gerry.RetryScheduler(base=10.0, seed=0)
+        self.assertTrue(retries.schedule('unit', Exception()))
+        self.assertEqual(len(retries), 1)
+        self.assertGreater(retries.wait_time(), 0)
+        self.assertLessEqual(retries.wait_time(), 10.0)
+        self.assertEqual(retries.pop_due(), [])
+
+        retries.base = 0
+        retries.schedule('other unit', Exception())
+        self.assertEqual(retries.pop_due(), ['other unit'])
+
+    def test_budget(self):
+        retries = gerry.RetryScheduler(base=0, budgets={'other': 2})
+        self.assertTrue(retries.schedule('unit', Exception()))
+        self.assertTrue(retries.schedule('unit', Exception()))
+        self.assertFalse(retries.schedule('unit', Exception('boom'), 'change 1'))
+        self.assertFalse(retries.schedule('404', requests.exceptions.HTTPError(response=mock_response(404))))
+        self.assertEqual(retries.dead_letters[0], {'unit': 'change 1', 'error_class': 'other',
+                                                   'attempts': 3, 'error': 'boom'})
+        self.assertEqual(len(retries.dead_letters), 2)
+
+
+class CrawlMetrics(unittest.TestCase):
+    def test_concurrent_export(self):
+        with tempfile.TemporaryDirectory() as directory:
+            metrics = gerry.CrawlMetrics('gerrit', directory, interval=0)
+
+            def observe():
+                for _ in range(200):
+                    metrics.observe_request('detail', 0.01, 100, 200)
+            with patch('gerry.log') as mock_log:
+                threads = [threading.Thread(target=observe) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            mock_log.warning.assert_not_called()
+            with open(os.path.join(directory, 'metrics.json')) as metrics_file:
+                self.assertEqual(json.load(metrics_file)['instance'], 'gerrit')
+            self.assertEqual(sorted(os.listdir(directory)), ['metrics.json', 'metrics.prom'])
+
+    def test_export_errors_do_not_fail_requests(self):
+        metrics = gerry.CrawlMetrics('gerrit', '/nonexistent', interval=0)
+        with patch('gerry.log') as mock_log:
+            metrics.observe_request('detail', 0.01, 100, 200)
+        mock_log.warning.assert_called_once()
+
+
+class Manifest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.manifest = gerry.Manifest(
+            os.path.join(self.temp_dir.name, 'manifest.sqlite'))
+
+    def tearDown(self):
+        self.manifest.connection.close()
+        self.temp_dir.cleanup()
+
+    def test_concurrent_open(self):
+        path = os.path.join(self.temp_dir.name, 'concurrent.sqlite')
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=gerry.Manifest, args=(path,)) for _ in range(8)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual([process.exitcode for process in processes], [0] * 8)
+
+    def test_legacy_schema(self):
+        path = os.path.join(self.temp_dir.name, 'legacy.sqlite')
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE days (day TEXT PRIMARY KEY, status TEXT NOT NULL, updated_at TEXT NOT NULL)')
+        connection.execute('CREATE TABLE changes (number INTEGER PRIMARY KEY, day TEXT NOT NULL, status TEXT NOT NULL, updated_at TEXT NOT NULL, error TEXT)')
+        connection.commit()
+        connection.close()
+        manifest = gerry.Manifest(path)
+        manifest.add_days(['2018-06-01'])
+        self.assertEqual(manifest.claim_days('worker', 1, 60), [('2018-06-01', 'pending')])
+        manifest.close()
+
+    def test_day_lifecycle(self):
+        self.manifest.add_days(['2018-06-01', '2018-06-02'])
+        self.assertEqual(self.manifest.pending_days(), [
+            ('2018-06-01', 'pending'), ('2018-06-02', 'pending')])
+
+        self.manifest.add_changes('2018-06-01', [1, 2])
+        self.assertEqual(self.manifest.pending_changes('2018-06-01'), [1, 2])
+
+        self.manifest.set_change_status(1, gerry.Manifest.DONE)
+        self.manifest.set_change_status(2, gerry.Manifest.FAILED, 'boom')
+        self.assertFalse(self.manifest.finish_day('2018-06-01'))
+        self.assertEqual(self.manifest.pending_changes('2018-06-01'), [2])
+
+        self.manifest.set_change_status(2, gerry.Manifest.DONE)
+        self.assertTrue(self.manifest.finish_day('2018-06-01'))
+        self.assertEqual(self.manifest.pending_days(),
+                         [('2018-06-02', 'pending')])
+
+    def test_claim_days(self):
+        self.manifest.add_days(['2018-06-01', '2018-06-02', '2018-06-03'])
+        self.assertEqual([day for day, _ in self.manifest.claim_days('a', 2, 60)],
+                         ['2018-06-01', '2018-06-02'])
+        self.assertEqual([day for day, _ in self.manifest.claim_days('b', 2, 60)],
+                         ['2018-06-03'])
+        self.assertEqual(self.manifest.claim_days('c', 2, 60), [])
+
+        # expired leases are claimed again
+        self.manifest.claim_days('b', 2, -1)
+        self.assertEqual([day for day, _ in self.manifest.claim_days('c', 2, 60)],
+                         ['2018-06-03'])
+
+        self.manifest.release_days('a')
+        self.assertEqual(len(self.manifest.claim_days('b', 2, 60)), 2)
+
+    def test_empty_day_is_done_after_listing(self):
+        self.manifest.add_days(['2018-06-01'])
+        self.manifest.add_changes('2018-06-01', [])
+        self.assertTrue(self.manifest.finish_day('2018-06-01'))
+        self.assertEqual(self.manifest.pending_days(), [])
+
+    def test_refresh_keeps_partly_listed_days(self):
+        self.manifest.add_days(['2018-06-01', '2018-06-02', '2018-06-03'])
+        self.manifest.add_changes('2018-06-01', [1], gerry.Manifest.DONE)
+        self.manifest.finish_day('2018-06-01')
+        # an interrupted and a failed listing with changes from their first page
+        self.manifest.add_changes('2018-06-02', [2], listed=False)
+        self.manifest.add_changes('2018-06-03', [3], listed=False)
+        self.manifest.set_day_status('2018-06-03', gerry.Manifest.FAILED)
+
+        self.manifest.refresh_changes('2018-06-04', [1])
+
+        self.assertEqual(self.manifest.pending_days(), [
+            ('2018-06-01', 'listed'), ('2018-06-02', 'pending'), ('2018-06-03', 'failed')])
+        self.assertEqual(self.manifest.pending_changes('2018-06-01'), [1])
+
+
+class RunAsync(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.gerry = gerry.Gerry('gerrit', 'https://gerrit-review.googlesource.com',
+                                 datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 3),
+                                 self.temp_dir.name, concurrency=4)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def list_changes(self, from_datetime, to_datetime):
+        changes = []
+        day = from_datetime
+        while day < to_datetime:
+            changes += [{'_number': day.day * 10 + 1, 'updated': day.strftime('%Y-%m-%d 12:00:00.000000000')},
+                        {'_number': day.day * 10 + 2, 'updated': day.strftime('%Y-%m-%d 13:00:00.000000000')}]
+            day += datetime.timedelta(days=1)
+        return changes
+
+    def list_pages(self, from_datetime, to_datetime):
+        return [self.list_changes(from_datetime, to_datetime)]
 
-    @patch('os.makedirs')
-    @patch('glob.glob')
-    @patch('os.listdir')
     @patch('gerry.Gerry.get_change')
-    def test_run(self, mock_get_change, mock_listdir,
-                 mock_glob, mock_makedirs):
-        mock_makedirs.return_value = True
-        mock_glob.return_value = [os.path.join(self.gerry.directory, self.gerry.name, 'changes', '2018-06-01'),
-                                  os.path.join(self.gerry.directory, self.gerry.name, 'changes', '2018-06-02')]
-        mock_listdir.return_value = False
+    @patch('gerry.Gerry.list_pages')
+    def test_run_async(self, mock_list_pages, mock_get_change):
+        mock_list_pages.side_effect = self.list_pages
+        mock_get_change.return_value = None
+
+        self.gerry.run_async()
+
+        day_path = os.path.join(self.gerry.directory, 'changes', '2018-06-01')
+        mock_get_change.assert_any_call(11, day_path, None)
+        mock_get_change.assert_any_call(12, day_path, None)
+        day_path = os.path.join(self.gerry.directory, 'changes', '2018-06-02')
+        mock_get_change.assert_any_call(21, day_path, None)
+        self.assertEqual(mock_get_change.call_count, 4)
+
+    @patch('gerry.Gerry.get_change')
+    @patch('gerry.Gerry.list_pages')
+    def test_run_async_retries_failed_day(self, mock_list_pages, mock_get_change):
+        mock_get_change.return_value = None
+        mock_list_pages.side_effect = [Exception('boom'), self.list_pages(
+            datetime.datetime(2018, 6, 2), datetime.datetime(2018, 6, 3)),
+            self.list_pages(datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 2))]
+
+        self.gerry.run_async()
+
+        self.assertEqual(mock_list_pages.call_count, 3)
+        self.assertEqual(mock_get_change.call_count, 4)
+
+    @patch('gerry.Gerry.get_change')
+    @patch('gerry.Gerry.list_pages')
+    def test_run_async_retries_only_failed_change(self, mock_list_pages, mock_get_change):
+        mock_list_pages.side_effect = self.list_pages
+        mock_get_change.side_effect = [None, Exception('boom'), None, None, None]
+
+        self.gerry.run_async()
+
+        self.assertEqual(mock_get_change.call_count, 5)
+
+    @patch('gerry.Gerry.get_change')
+    @patch('gerry.Gerry.list_pages')
+    def test_run_async_completes_legacy_days(self, mock_list_pages, mock_get_change):
+        mock_list_pages.side_effect = self.list_pages
+        mock_get_change.return_value = None
+        day_path = os.path.join(self.gerry.directory, 'changes', '2018-06-01')
+        os.makedirs(day_path)
+        with open(os.path.join(day_path, '11.json'), 'w') as change_file:
+            json.dump({'_number': 11}, change_file)
+
+        self.gerry.run_async()
+
+        # the day is listed again, only the missing change is fetched
+        mock_get_change.assert_any_call(12, day_path, None)
+        self.assertEqual(mock_get_change.call_count, 3)
+
+
+class RunIncremental(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.gerry = gerry.Gerry('gerrit', 'https://gerrit-review.googlesource.com',
+                                 datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 3),
+                                 self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @patch('gerry.Gerry.get_change')
+    @patch('gerry.Gerry.list_pages')
+    def test_run_incremental(self, mock_list_pages, mock_get_change):
+        mock_list_pages.return_value = [[
+            {'_number': 11, 'updated': '2018-06-01 12:00:00.000000000'}]]
+        mock_get_change.return_value = '"etag-11"'
+
+        self.gerry.run_incremental(self.gerry.run)
+        self.assertEqual(self.gerry.manifest.get_state('high_water_mark'),
+                         '2018-06-03 00:00:00.000')
+
+        mock_list_pages.return_value = [[
+            {'_number': 11, 'updated': '2018-06-04 08:00:00.000000000'},
+            {'_number': 12, 'updated': '2018-06-04 09:00:00.000000000'}]]
+        mock_get_change.reset_mock()
+
+        self.gerry.run_incremental(self.gerry.run)
+
+        mock_list_pages.assert_called_with(
+            datetime.datetime(2018, 6, 3), unittest.mock.ANY)
+        # the updated change is rewritten in its original day folder
+        mock_get_change.assert_any_call(11, os.path.join(
+            self.gerry.directory, 'changes', '2018-06-01'), '"etag-11"')
+        mock_get_change.assert_any_call(12, os.path.join(
+            self.gerry.directory, 'changes', '2018-06-04'), None)
+        self.assertEqual(mock_get_change.call_count, 2)
+        self.assertEqual(self.gerry.manifest.get_state('high_water_mark'),
+                         '2018-06-04 09:00:00.000')
+        self.assertEqual(self.gerry.manifest.pending_days(), [])
+
+
+class RunBatch(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.gerry = gerry.Gerry('gerrit', 'https://gerrit-review.googlesource.com',
+                                 datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 2),
+                                 self.temp_dir.name, batch=True)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @patch('gerry.Gerry.get_change')
+    @patch('gerry.Gerry.get')
+    def test_run_batch(self, mock_get, mock_get_change):
+        mock_get.return_value = mock_response(200)
+        mock_get.return_value.text = ")]}'\n" + json.dumps([
+            {'_number': 1, 'updated': '2018-06-01 12:00:00.000000000', 'messages': [], 'revisions': {}},
+            {'_number': 2, 'updated': '2018-06-01 13:00:00.000000000'}])
+        mock_get_change.return_value = None
 
         self.gerry.run()
-        # valid change number from 2018-06-01
-        mock_get_change.assert_any_call(109611, mock_glob.return_value[0])
-        # valid change number from 2018-06-02
-        mock_get_change.assert_any_call(181990, mock_glob.return_value[1])
 
+        # the day is probed without the detail options first
+        self.assertNotIn('&o=', mock_get.call_args_list[0][0][0])
+        self.assertIn('&o=MESSAGES', mock_get.call_args[0][0])
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(self.gerry.storage.read(1)['_number'], 1)
+        # the change without details falls back to the detail request
+        mock_get_change.assert_called_once_with(2, os.path.join(
+            self.gerry.directory, 'changes', '2018-06-01'), None)
+
+
+class RunInstances(unittest.TestCase):
+    def test_select_instances(self):
+        names = ['openstack', 'chromium', 'gerrit']
+        self.assertEqual(gerry.select_instances('all', names), names)
+        self.assertEqual(gerry.select_instances('gerrit,openstack', names),
+                         ['gerrit', 'openstack'])
+        self.assertRaises(gerry.argparse.ArgumentTypeError,
+                          gerry.select_instances, 'gerrit,qt', names)
+
+    @patch('os.makedirs')
+    def test_run_instances(self, mock_makedirs):
+        budget = gerry.RateController('budget', rate=100.0, increase=0)
+        gerries = [gerry.Gerry(name, 'https://%s' % name, datetime.datetime(2018, 6, 1),
+                               datetime.datetime(2018, 6, 2), './gerry_data/', budget=budget)
+                   for name in ['openstack', 'chromium', 'gerrit']]
+        crawled = []
+
+        def run_instance(instance):
+            if instance.name == 'chromium':
+                raise Exception('boom')
+            crawled.append(instance.name)
+
+        gerry.run_instances(gerries, run_instance)
+
+        self.assertEqual(sorted(crawled), ['gerrit', 'openstack'])
+        self.assertIs(gerries[0].budget, gerries[2].budget)
+
+
+class RunWorkers(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def create_gerry(self):
+        return gerry.Gerry('gerrit', 'https://gerrit-review.googlesource.com',
+                           datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 13),
+                           self.temp_dir.name)
+
+    def test_run_workers(self):
+        def list_pages(from_datetime, to_datetime):
+            return [[{'_number': int(day.strftime('%m%d')), 'updated': day.strftime('%Y-%m-%d 12:00:00.000000000')}
+                    for day in [from_datetime + datetime.timedelta(days=i)
+                                for i in range((to_datetime - from_datetime).days + 1)]]]
+
+        def get_change(change_number, folder, etag=None):
+            with open(os.path.join(folder, '%i.json' % change_number), 'a') as change_file:
+                change_file.write('%i\n' % os.getpid())
+
+        # workers that find every pending day leased poll instead of waiting
+        with patch('gerry.Gerry.list_pages', side_effect=list_pages), \
+                patch('gerry.Gerry.get_change', side_effect=get_change), \
+                patch('time.sleep'):
+            gerry.run_workers(self.create_gerry, 3)
+
+        instance = self.create_gerry()
+        instance.create_day_paths()
+        self.assertEqual(instance.manifest.pending_days(), [])
+        change_files = glob.glob(os.path.join(instance.directory, 'changes', '*', '*.json'))
+        self.assertEqual(len(change_files), 12)
+        for change_file in change_files:
+            with open(change_file) as lines:
+                self.assertEqual(len(lines.readlines()), 1)
+
+    def test_run_incremental_workers(self):
+        updated = {'2018-06-01': '2018-06-01 12:00:00.000000000'}
+
+        def list_pages(from_datetime, to_datetime):
+            return [[{'_number': int(day[5:].replace('-', '')), 'updated': timestamp}
+                     for day, timestamp in updated.items()
+                     if from_datetime <= gerry.parse_gerrit_timestamp(timestamp) <= to_datetime]]
+
+        def get_change(change_number, folder, etag=None):
+            with open(os.path.join(folder, '%i.json' % change_number), 'a') as change_file:
+                change_file.write('%i\n' % os.getpid())
+
+        def run_incremental():
+            instance = self.create_gerry()
+
+            def run():
+                # like __main__, the parent closes its connections before forking
+                instance.close()
+                gerry.run_workers(self.create_gerry, 2)
+            instance.run_incremental(run)
+            return instance
+
+        with patch('gerry.Gerry.list_pages', side_effect=list_pages), \
+                patch('gerry.Gerry.get_change', side_effect=get_change), \
+                patch('time.sleep'):
+            run_incremental()
+            # the change is updated after the first run and refreshed by the
+            # workers in place
+            updated['2018-06-01'] = '2018-06-14 08:00:00.000000000'
+            instance = run_incremental()
+
+        self.assertEqual(instance.manifest.get_state('high_water_mark'),
+                         '2018-06-14 08:00:00.000')
+        with open(os.path.join(instance.directory, 'changes', '2018-06-01', '601.json')) as lines:
+            self.assertEqual(len(lines.readlines()), 2)
+
+    def test_leases_are_renewed_during_long_windows(self):
+        instance = self.create_gerry()
+        claimed = []
+
+        def crawl_window(day_strs, unlisted):
+            # three times the lease, the heartbeat keeps the days leased
+            if day_strs == ['2018-06-01']:
+                time.sleep(0.6)
+                claimed.extend(instance.manifest.claim_days('other', 32, 60))
+            return True
+
+        with patch('gerry.Gerry.crawl_window', side_effect=crawl_window):
+            instance.run_worker('worker', claim_size=12, lease_seconds=0.2)
+        self.assertEqual(claimed, [])
+
+
+class MockServer(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.mock = mock_gerrit.MockGerrit(mock_gerrit.synthetic_changes(
+            120, datetime.datetime(2018, 6, 1), 3), retry_after=0)
+        self.gerry = gerry.Gerry('mock', self.mock.start(), datetime.datetime(2018, 6, 1),
+                                 datetime.datetime(2018, 6, 4), self.temp_dir.name,
+                                 rate=1000.0, page_size=25)
+        self.gerry.rate_controller.max_rate = 1000.0
+        self.gerry.retries.base = 0.01
+
+    def tearDown(self):
+        self.mock.stop()
+        self.temp_dir.cleanup()
+
+    def test_run(self):
+        self.gerry.run()
+        self.assertEqual(self.gerry.manifest.summary(), ({'done': 3}, {'done': 120}))
+        self.assertEqual(self.gerry.storage.read(7)['_number'], 7)
+
+    def test_run_async_with_errors(self):
+        self.mock.error_rates = {429: 0.05, 500: 0.01, 503: 0.05}
+        self.gerry.rate_controller.min_rate = 100.0
+        self.gerry.run_async()
+        self.assertGreater(self.mock.error_count, 0)
+        self.assertEqual(self.gerry.manifest.summary(), ({'done': 3}, {'done': 120}))
+
+    def test_details_are_fetched_while_listing(self):
+        self.mock.changes = [change for change in self.mock.changes if change['updated'] < '2018-06-02']
+        self.gerry.end_date = datetime.datetime(2018, 6, 2)
+        endpoints = []
+        get = self.gerry.get
+
+        def record_get(url, headers=None, endpoint='detail'):
+            endpoints.append(endpoint)
+            return get(url, headers, endpoint)
+        with patch.object(self.gerry, 'get', side_effect=record_get):
+            self.gerry.run()
+
+        self.assertGreater(len(self.mock.changes), self.gerry.page_size)
+        self.assertLess(endpoints.index('detail'), len(endpoints) - endpoints[::-1].index('changes'))
+        self.assertEqual(endpoints.count('detail'), len(self.mock.changes))
+
+    def test_metrics(self):
+        self.gerry.run()
+        with open(os.path.join(self.gerry.directory, 'metrics.json')) as metrics_file:
+            metrics = json.load(metrics_file)
+        self.assertEqual(metrics['changes'], 120)
+        self.assertEqual(metrics['endpoints']['detail']['status_codes'], {'200': 120})
+        self.assertGreater(metrics['endpoints']['changes']['bytes'], 0)
+        self.assertIn('write', metrics['stages'])
+        with open(os.path.join(self.gerry.directory, 'metrics.prom')) as metrics_file:
+            self.assertIn('gerry_request_seconds_count{instance="mock",endpoint="detail"} 120',
+                          metrics_file.read())
+
+    def test_response_cache(self):
+        self.gerry.cache = gerry_storage.ResponseCache(
+            os.path.join(self.gerry.directory, 'cache.sqlite'))
+        folder = os.path.join(self.gerry.directory, 'changes', '2018-06-01')
+        os.makedirs(folder)
+        etag = self.gerry.get_change(7, folder)
+        self.assertEqual(self.gerry.get_change(7, folder), etag)
+        self.assertEqual(self.mock.request_count, 1)
+        self.assertEqual(self.gerry.storage.read(7)['_number'], 7)
+        # incremental refreshes revalidate with the server
+        self.gerry.get_change(7, folder, etag)
+        self.assertEqual(self.mock.request_count, 2)
+        self.gerry.cache.close()
+
+    def test_run_gives_up_on_client_errors(self):
+        self.mock.error_rates = {404: 1.0}
+        self.gerry.run()
+        with open(os.path.join(self.gerry.directory, 'dead_letters.json')) as report_file:
+            dead_letters = json.load(report_file)
+        # one listing per day and no retries
+        self.assertEqual(self.mock.request_count, 3)
+        self.assertEqual(len(dead_letters), 3)
+        self.assertEqual(dead_letters[0]['unit'], 'changes from 2018-06-01 to 2018-06-01')
+        self.assertEqual(dead_letters[0]['error_class'], 'client')
+
+    def test_refresh_bypasses_cache(self):
+        self.gerry.cache = gerry_storage.ResponseCache(
+            os.path.join(self.gerry.directory, 'cache.sqlite'))
+        self.gerry.run_incremental(self.gerry.run)
+        # as if the server sent no ETags
+        with self.gerry.manifest.connection:
+            self.gerry.manifest.connection.execute('UPDATE changes SET etag = NULL')
+        change = self.mock.changes_by_number[5]
+        change['subject'] = 'Changed'
+        change['updated'] = '2018-06-05 12:00:00.000000000'
+
+        self.gerry.run_incremental(self.gerry.run)
+        self.assertEqual(self.gerry.storage.read(5)['subject'], 'Changed')
+        self.gerry.cache.close()
+
+    def test_get_change_not_modified(self):
+        folder = os.path.join(self.gerry.directory, 'changes', '2018-06-01')
+        os.makedirs(folder)
+        etag = self.gerry.get_change(7, folder)
+        with patch('gerry_storage.DirectoryStorage.write') as mock_write:
+            self.assertEqual(self.gerry.get_change(7, folder, etag), etag)
+        mock_write.assert_not_called()
+
+
+class ListChanges(unittest.TestCase):
+    @patch('os.makedirs')
+    def setUp(self, mock_makedirs):
+        self.gerry = gerry.Gerry('gerrit', 'https://gerrit-review.googlesource.com',
+                                 datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 2),
+                                 './gerry_data/', page_size=2)
+
+    @patch('gerry.Gerry.query_changes')
+    def test_list_changes_splits_busy_window(self, mock_query_changes):
+        def query_changes(from_datetime, to_datetime, offset=0, details=True):
+            if to_datetime - from_datetime > datetime.timedelta(hours=12):
+                return [{'_number': 1}, {'_number': 2, '_more_changes': True}], True
+            return [{'_number': from_datetime.hour}], False
+        mock_query_changes.side_effect = query_changes
+
+        changes = self.gerry.list_changes(
+            datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 1, 23, 59, 59, 999000))
+
+        self.assertEqual([change['_number'] for change in changes], [0, 12])
+        self.assertEqual(mock_query_changes.call_args_list[1][0],
+                         (datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 1, 11, 59, 59, 999000)))
+        self.assertEqual(mock_query_changes.call_args_list[2][0],
+                         (datetime.datetime(2018, 6, 1, 12), datetime.datetime(2018, 6, 1, 23, 59, 59, 999000)))
+
+    @patch('gerry.Gerry.query_changes')
+    def test_list_changes_pages_smallest_window(self, mock_query_changes):
+        mock_query_changes.side_effect = [
+            ([{'_number': 1}, {'_number': 2, '_more_changes': True}], True),
+            ([{'_number': 3}], False)]
+
+        changes = self.gerry.list_changes(
+            datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 1, 0, 0, 30))
+
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(mock_query_changes.call_args[0][2], 2)
+
+    @patch('gerry.Gerry.query_changes')
+    def test_list_changes_batch_probes_busy_window(self, mock_query_changes):
+        def query_changes(from_datetime, to_datetime, offset=0, details=True):
+            if to_datetime - from_datetime > datetime.timedelta(hours=12):
+                return [{'_number': 1}, {'_number': 2, '_more_changes': True}], True
+            return [{'_number': from_datetime.hour, 'details': details}], False
+        mock_query_changes.side_effect = query_changes
+        self.gerry.batch = True
+
+        changes = self.gerry.list_changes(
+            datetime.datetime(2018, 6, 1), datetime.datetime(2018, 6, 1, 23, 59, 59, 999000))
+
+        self.assertEqual(changes, [{'_number': 0, 'details': True},
+                                   {'_number': 12, 'details': True}])
+        self.assertEqual([call[1]['details'] for call in mock_query_changes.call_args_list[:2]],
+                         [False, False])
+
+    def test_listing_windows_merge_unlisted_days(self):
+        self.gerry.window_days = 2
+        days = [('2018-06-01', 'pending'), ('2018-06-02', 'failed'),
+                ('2018-06-03', 'pending'), ('2018-06-04', 'listed'),
+                ('2018-06-05', 'pending'), ('2018-06-07', 'pending')]
+        self.assertEqual(list(self.gerry.listing_windows(days)), [
+            (['2018-06-01', '2018-06-02'], True), (['2018-06-03'], True),
+            (['2018-06-04'], False), (['2018-06-05'], True), (['2018-06-07'], True)])
 
 if __name__ == '__main__':
     unittest.main()
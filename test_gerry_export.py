@@ -0,0 +1,76 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+import gerry_export
+import gerry_storage
+import mock_gerrit
+
+
+class Export(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.changes = mock_gerrit.synthetic_changes(
+            20, datetime.datetime(2018, 6, 1), 2, payload_size=40)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_changes(self, storage, changes):
+        for change in changes:
+            folder = os.path.join(self.temp_dir.name, 'changes', change['updated'][:10])
+            storage.prepare_day(folder)
+            storage.write(folder, change['_number'], change)
+
+    def test_export(self):
+        self.write_changes(gerry_storage.DirectoryStorage(self.temp_dir.name), self.changes)
+        self.assertEqual(gerry_export.export(self.temp_dir.name, processes=2), ['2018-06'])
+
+        changes = gerry_export.read_table(self.temp_dir.name, 'changes', ['change', 'status'])
+        self.assertEqual(sorted(changes['change']), list(range(1, 21)))
+        messages = gerry_export.read_table(self.temp_dir.name, 'messages', ['change'])
+        self.assertEqual(len(messages['change']), 80)
+        files = gerry_export.read_table(self.temp_dir.name, 'files')
+        self.assertEqual(len(files['path']), sum(len(change['revisions']) for change in self.changes))
+        labels = gerry_export.read_table(self.temp_dir.name, 'labels', months=['2018-06'])
+        self.assertEqual(set(labels['value']), {2})
+
+    def test_export_is_incremental(self):
+        storage = gerry_storage.DirectoryStorage(self.temp_dir.name)
+        self.write_changes(storage, self.changes)
+        gerry_export.export(self.temp_dir.name, processes=1)
+        self.assertEqual(gerry_export.export(self.temp_dir.name, processes=1), [])
+
+        change = dict(self.changes[0], status='ABANDONED', insertions=-1)
+        self.write_changes(storage, [change])
+        os.utime(os.path.join(self.temp_dir.name, 'changes', change['updated'][:10],
+                              '%i.json' % change['_number']), ns=(0, 0))
+        self.assertEqual(gerry_export.export(self.temp_dir.name, processes=1),
+                         [change['updated'][:7]])
+        changes = gerry_export.read_table(self.temp_dir.name, 'changes', ['insertions'])
+        self.assertIn(-1, changes['insertions'])
+
+    def test_export_partitions_by_month(self):
+        changes = mock_gerrit.synthetic_changes(
+            20, datetime.datetime(2018, 6, 29), 4, payload_size=40)
+        self.write_changes(gerry_storage.DirectoryStorage(self.temp_dir.name), changes)
+        self.assertEqual(gerry_export.export(self.temp_dir.name, processes=1),
+                         ['2018-06', '2018-07'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.temp_dir.name, 'export', 'changes'))),
+                         ['2018-06', '2018-07'])
+        changes_in_july = gerry_export.read_table(self.temp_dir.name, 'changes', ['day'], months=['2018-07'])
+        self.assertEqual(sorted(changes_in_july['day']),
+                         sorted(change['updated'][:10] for change in changes if change['updated'][5:7] == '07'))
+
+    def test_export_shards(self):
+        storage = gerry_storage.ShardStorage(self.temp_dir.name)
+        self.write_changes(storage, self.changes)
+        storage.close()
+        gerry_export.export(self.temp_dir.name, 'shards', processes=1)
+        revisions = gerry_export.read_table(self.temp_dir.name, 'revisions', ['change'])
+        self.assertEqual(len(revisions['change']), sum(len(change['revisions']) for change in self.changes))
+
+
+if __name__ == '__main__':
+    unittest.main()
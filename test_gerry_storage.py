@@ -0,0 +1,153 @@
+import datetime
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+import gerry_storage
+import mock_gerrit
+
+
+class ShardStorage(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.storage = gerry_storage.ShardStorage(self.temp_dir.name)
+        self.day_path = os.path.join(
+            self.temp_dir.name, 'changes', '2018-06-01')
+
+    def tearDown(self):
+        self.storage.close()
+        self.temp_dir.cleanup()
+
+    def test_write_read(self):
+        self.storage.write(self.day_path, 1, {'_number': 1})
+        self.storage.write_raw(self.day_path, 2, b'{"_number": 2}')
+        self.assertEqual(self.storage.read(1), {'_number': 1})
+        self.assertEqual(self.storage.read(2), {'_number': 2})
+        self.assertEqual(self.storage.read_raw(2), b'{"_number": 2}\n')
+        self.assertRaises(KeyError, self.storage.read, 3)
+
+    def test_rewrite_moves_index(self):
+        self.storage.write(self.day_path, 1, {'_number': 1, 'status': 'NEW'})
+        self.storage.write(self.day_path, 1, {'_number': 1, 'status': 'MERGED'})
+        self.assertEqual(self.storage.read(1)['status'], 'MERGED')
+        self.assertEqual(len(list(self.storage.iter_changes())), 1)
+
+    def test_shard_is_gzip_json_lines(self):
+        self.storage.write(self.day_path, 1, {'_number': 1})
+        self.storage.write(os.path.join(
+            self.temp_dir.name, 'changes', '2018-06-30'), 2, {'_number': 2})
+        with gzip.open(os.path.join(self.storage.shard_directory, '2018-06.jsonl.gz')) as shard:
+            self.assertEqual(shard.read().splitlines(),
+                             [b'{"_number": 1}', b'{"_number": 2}'])
+
+    def test_granularity_is_kept(self):
+        self.assertRaises(ValueError, gerry_storage.ShardStorage,
+                          self.temp_dir.name, 'day')
+        directory = os.path.join(self.temp_dir.name, 'daily')
+        storage = gerry_storage.ShardStorage(directory, 'day')
+        storage.write(self.day_path, 1, {'_number': 1})
+        storage.close()
+
+        storage = gerry_storage.ShardStorage(directory)
+        self.assertEqual(storage.granularity, 'day')
+        storage.write(self.day_path, 2, {'_number': 2})
+        storage.close()
+        self.assertEqual([name for name in os.listdir(storage.shard_directory) if name.endswith('.gz')],
+                         ['2018-06-01.jsonl.gz'])
+
+    def test_iter_day_reads_every_shard(self):
+        self.storage.write(self.day_path, 1, {'_number': 1})
+        # a change whose shard differs from the rest of its day
+        with self.storage.connection:
+            self.storage.connection.execute(
+                "UPDATE changes SET shard = '2018-06-01.jsonl.gz' WHERE number = 1")
+        os.rename(os.path.join(self.storage.shard_directory, '2018-06.jsonl.gz'),
+                  os.path.join(self.storage.shard_directory, '2018-06-01.jsonl.gz'))
+        self.storage.write(self.day_path, 2, {'_number': 2})
+        self.assertEqual(list(self.storage.iter_day('2018-06-01')),
+                         [(1, {'_number': 1}), (2, {'_number': 2})])
+
+    def test_convert(self):
+        source = gerry_storage.DirectoryStorage(self.temp_dir.name)
+        source.prepare_day(self.day_path)
+        source.write(self.day_path, 1, {'_number': 1})
+        source.write(self.day_path, 2, {'_number': 2})
+
+        self.assertEqual(gerry_storage.convert(source, self.storage), 2)
+        self.assertEqual([(folder, change_number) for folder, change_number, _ in self.storage.iter_changes()],
+                         [(self.day_path, 1), (self.day_path, 2)])
+
+
+class AccountStorage(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.storage = gerry_storage.create_storage('files', self.temp_dir.name, intern_accounts=True)
+        self.day_path = os.path.join(self.temp_dir.name, 'changes', '2018-06-01')
+        self.storage.prepare_day(self.day_path)
+        self.change = mock_gerrit.synthetic_changes(1, datetime.datetime(2018, 6, 1), 1)[0]
+
+    def tearDown(self):
+        self.storage.close()
+        self.temp_dir.cleanup()
+
+    def test_write_read(self):
+        self.storage.write(self.day_path, 1, self.change)
+        stored = self.storage.storage.read(1)
+        self.assertEqual(stored['owner'], {'_account_id': self.change['owner']['_account_id']})
+        self.assertEqual(set(stored['labels']['Code-Review']['all'][0]), {'_account_id', 'value'})
+        self.assertEqual(self.storage.read(1), self.change)
+        self.assertEqual(list(self.storage.iter_changes()), [(self.day_path, 1, self.change)])
+
+    def test_accounts_are_shared(self):
+        self.storage.write_raw(self.day_path, 1, json.dumps(self.change).encode())
+        storage = gerry_storage.create_storage('files', self.temp_dir.name, intern_accounts=True)
+        self.assertEqual(json.loads(storage.read_raw(1)), self.change)
+        storage.close()
+
+
+class ResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = gerry_storage.ResponseCache(
+            os.path.join(self.temp_dir.name, 'cache.sqlite'), max_bytes=100)
+
+    def tearDown(self):
+        self.cache.close()
+        self.temp_dir.cleanup()
+
+    def test_normalize_url(self):
+        self.assertEqual(gerry_storage.normalize_url('https://Gerrit.example.com/changes/1/detail/?o=B&o=A'),
+                         gerry_storage.normalize_url('https://gerrit.example.com/changes/1/detail?o=A&o=B'))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('http://gerrit/changes/1/detail'))
+        self.cache.put('http://gerrit/changes/1/detail/', b'{}', '"1"', immutable=True)
+        self.assertEqual(self.cache.get('http://gerrit/changes/1/detail'), (b'{}', '"1"'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_invalidate(self):
+        self.cache.put('http://gerrit/changes/1/detail', b'{}', immutable=True)
+        self.cache.invalidate(['http://gerrit/changes/1/detail/'])
+        self.assertIsNone(self.cache.get('http://gerrit/changes/1/detail'))
+
+    def test_mutable_entries_expire(self):
+        self.cache.ttl = -1
+        self.cache.put('http://gerrit/changes/1/detail', b'{}')
+        self.cache.put('http://gerrit/changes/2/detail', b'{}', immutable=True)
+        self.assertIsNone(self.cache.get('http://gerrit/changes/1/detail'))
+        self.assertIsNotNone(self.cache.get('http://gerrit/changes/2/detail'))
+
+    def test_evicts_least_recently_used(self):
+        for change_number in range(4):
+            self.cache.put('http://gerrit/changes/%i/detail' % change_number, b'x' * 30, immutable=True)
+            self.cache.get('http://gerrit/changes/0/detail')
+        self.assertIsNotNone(self.cache.get('http://gerrit/changes/0/detail'))
+        self.assertIsNone(self.cache.get('http://gerrit/changes/1/detail'))
+        self.assertLessEqual(self.cache.stats()['bytes'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import argparse
+import datetime
+import json
+import os
+import queue
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+import benchmark
+import mock_gerrit
+import qt_gerry_crawler
+
+
+class FakeCollection(object):
+    # applies the ReplaceOne upserts of bulk_write to documents keyed on
+    # their filter
+    def __init__(self, name):
+        self.name = name
+        self.documents = {}
+        self.bulk_writes = []
+
+    def create_index(self, keys):
+        pass
+
+    def bulk_write(self, operations, ordered=True):
+        self.bulk_writes.append(len(operations))
+        for operation in operations:
+            self.documents[tuple(sorted(operation._filter.items()))] = operation._doc
+
+    def count_documents(self, filter):
+        return len(self.documents)
+
+
+class FakeDatabase(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection(name)
+        return self[name]
+
+
+class FakeClient(dict):
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __missing__(self, name):
+        self[name] = FakeDatabase()
+        return self[name]
+
+    def drop_database(self, name):
+        pass
+
+
+class CrawlDetail(unittest.TestCase):
+    def setUp(self):
+        self.changes = mock_gerrit.synthetic_changes(
+            5, datetime.datetime(2018, 6, 1), 1, payload_size=40)
+        self.mock = mock_gerrit.MockGerrit(self.changes)
+        patcher = patch('qt_gerry_crawler.base_url', self.mock.start() + '/')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_split_inline_comments(self):
+        inlines = qt_gerry_crawler.splitInlineComments(7, {
+            'src/a.py': [{'patch_set': 2, 'line': 1}, {'patch_set': 1, 'line': 2}],
+            'README': [{'patch_set': 2, 'line': 3}]})
+        self.assertEqual(inlines, [
+            {'_number': 7, 'rev_num': 1, 'inline_comments': {'src/a_py': [{'patch_set': 1, 'line': 2}]}},
+            {'_number': 7, 'rev_num': 2, 'inline_comments': {
+                'src/a_py': [{'patch_set': 2, 'line': 1}], 'README': [{'patch_set': 2, 'line': 3}]}}])
+
+    def test_crawl_detail(self):
+        change = max(self.changes, key=lambda change: len(change['revisions']))
+        det_inl = qt_gerry_crawler.crawl_detail(change['_number'], len(change['revisions']))
+
+        self.assertEqual([comment['_number'] for comment in det_inl['comments']], [change['_number']])
+        self.assertEqual([inline['rev_num'] for inline in det_inl['inlines']],
+                         list(range(1, len(change['revisions']) + 1)))
+        for inline in det_inl['inlines']:
+            self.assertEqual(inline['_number'], change['_number'])
+            self.assertEqual(list(inline['inline_comments']), ['src/file%i_py' % inline['rev_num']])
+
+    def test_crawl_detail_without_revisions(self):
+        det_inl = qt_gerry_crawler.crawl_detail(self.changes[0]['_number'], 0)
+        self.assertEqual(det_inl['inlines'], [])
+        self.assertEqual(self.mock.request_count, 1)
+
+
+class Pipeline(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        # dead letter reports go to the working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.temp_dir.name)
+        self.changes = mock_gerrit.synthetic_changes(
+            30, datetime.datetime(2018, 6, 1), 2, payload_size=40)
+        self.mock = mock_gerrit.MockGerrit(self.changes)
+        self.collections = {name: FakeCollection(name) for name in ['reviews', 'comments', 'inlines']}
+        for name, value in [('base_url', self.mock.start() + '/'), ('multiThread_cpu_num', 3),
+                            ('bulk_write_size', 3),
+                            ('changes_collection', self.collections['reviews']),
+                            ('comments_collection', self.collections['comments']),
+                            ('inlines_collection', self.collections['inlines'])]:
+            patcher = patch('qt_gerry_crawler.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.mock.stop()
+        self.temp_dir.cleanup()
+
+    def test_write_worker_batches(self):
+        write_queue = queue.Queue()
+        for number in range(1, 8):
+            write_queue.put((self.collections['reviews'], qt_gerry_crawler.upsertOperations(
+                [{'_number': number}], ['_number'])))
+        write_queue.put(None)
+
+        qt_gerry_crawler.writeWorker(write_queue)
+
+        self.assertEqual(self.collections['reviews'].bulk_writes, [3, 3, 1])
+        self.assertEqual(len(self.collections['reviews'].documents), 7)
+
+    def test_crawl_is_idempotent(self):
+        merged = [change for change in self.changes if change['status'] == 'MERGED']
+        qt_gerry_crawler.crawl_new_api('merged', 10)
+
+        numbers = sorted((('_number', change['_number']),) for change in merged)
+        self.assertEqual(sorted(self.collections['reviews'].documents), numbers)
+        self.assertEqual(sorted(self.collections['comments'].documents), numbers)
+        self.assertEqual(sorted(self.collections['inlines'].documents), sorted(
+            (('_number', change['_number']), ('rev_num', revision['_number']))
+            for change in merged for revision in change['revisions'].values()))
+
+        counts = {name: len(collection.documents) for name, collection in self.collections.items()}
+        qt_gerry_crawler.crawl_new_api('merged', 10)
+        self.assertEqual({name: len(collection.documents) for name, collection in self.collections.items()},
+                         counts)
+
+    def test_dead_letters_per_status(self):
+        crawl_detail = qt_gerry_crawler.crawl_detail
+
+        def failing_crawl_detail(reviewIdNum, latestPatchSetNum):
+            if reviewIdNum % 5 == 0:
+                raise requests.exceptions.HTTPError('404', response=MagicMock(status_code=404))
+            return crawl_detail(reviewIdNum, latestPatchSetNum)
+
+        with patch('qt_gerry_crawler.crawl_detail', side_effect=failing_crawl_detail):
+            for status in ['merged', 'abandoned']:
+                qt_gerry_crawler.crawl_new_api(status, 10)
+
+        for status in ['merged', 'abandoned']:
+            with open('dead_letters_%s.json' % status) as report_file:
+                self.assertEqual(sorted(dead_letter['unit'] for dead_letter in json.load(report_file)), sorted(
+                    'change %i' % change['_number'] for change in self.changes
+                    if change['status'] == status.upper() and change['_number'] % 5 == 0))
+
+
+class Benchmark(unittest.TestCase):
+    @patch('pymongo.MongoClient', FakeClient)
+    def test_qt_scenario(self):
+        args = argparse.Namespace(changes=60, days=2, payload_size=40, latency=0.0,
+                                  error_rate=0.0, concurrency=4, page_size=25)
+        result = benchmark.benchmark('qt', args)
+        self.assertNotIn('error', result)
+        self.assertEqual(result['changes'], 60)
+
+
+if __name__ == '__main__':
+    unittest.main()